@@ -1,8 +1,30 @@
 from SCons.Script import *
+import SCons.Node.FS
+import SCons.CacheDir
+import SCons.Action
+import SCons.Defaults
+import SCons.Taskmaster
+import SCons.Tool
+import SCons.SConsign
+import SCons.Util
 import sys
 import os
 from os.path import join
 import re
+import subprocess
+import atexit
+import time
+import hashlib
+import struct
+import json
+import socket
+import threading
+import Queue
+import httplib
+import urlparse
+import tempfile
+import BaseHTTPServer
+import SocketServer
 
 '''
 Copyright (c) 2015, Dan Newman <dan.newman@mtbaldy.us>
@@ -82,6 +104,307 @@ NOTE: VariantDir() and Repository() cannot be used effectively with an
    presently no better alternatives.
 '''
 
+class BoardInfo(object):
+    '''
+    What ConfigureBoard() learned about a board.  Only the values the
+    tool itself uses are kept; the strings are interned so that a build
+    configuring many boards shares a single copy of each.  The full
+    boards.txt and platform.txt contents are available from raw() which
+    re-reads the files each time it is called.
+    '''
+
+    __slots__ = ( 'board', 'name', 'version', 'version_path', 'arch',
+                  'f_cpu', 'mcu', 'variant', 'core', 'vid', 'pid',
+                  'variant_system_lib', 'hardware_path', 'arduino_path',
+                  'arch_path' )
+
+    def __init__(self, **kw):
+        for slot in self.__slots__:
+            value = kw.get(slot)
+            if type(value) is str:
+                value = intern(value)
+            setattr(self, slot, value)
+
+    def raw(self):
+        '''
+        Return a new dictionary holding the board's boards.txt entries
+        (without the board prefix) and all of platform.txt, unsubstituted
+        '''
+        tab = {}
+        with open(join(self.arch_path, 'boards.txt')) as f:
+            for line in f:
+                line = line.strip()
+                if line and line[0] != '#' and line.startswith(self.board + '.'):
+                    lhs, rhs = line.split('=', 1)
+                    tab[lhs[len(self.board) + 1:]] = rhs
+        with open(join(self.arch_path, 'platform.txt')) as f:
+            for line in f:
+                line = line.strip()
+                if line and line[0] != '#':
+                    lhs, rhs = line.split('=', 1)
+                    tab[lhs] = rhs
+        return tab
+
+    def footprint(self):
+        '''
+        Approximate number of bytes held by this record.  Interned strings
+        shared with other records are counted for each record.
+        '''
+        size = sys.getsizeof(self)
+        for slot in self.__slots__:
+            size += sys.getsizeof(getattr(self, slot))
+        return size
+
+    def __repr__(self):
+        return 'BoardInfo(%s)' % ', '.join(
+            [ '%s=%r' % (slot, getattr(self, slot)) for slot in self.__slots__ ])
+
+class LazyLibrary(object):
+    '''
+    An ArduinoLibrary() declared with ARDUINO_LAZY_LIBRARIES set.  Nothing
+    is globbed, no nodes are made and CPPPATH is left alone until a
+    Sketch() or Elf() links the library and realize() is called.
+    '''
+
+    def __init__(self, name, build):
+        self.name = name
+        self.build = build
+        self.nodes = None
+
+    def realize(self):
+        '''
+        Declare the library for real, once, and return its archive nodes
+        '''
+        if self.nodes is None:
+            self.nodes = self.build()
+        return self.nodes
+
+    def __repr__(self):
+        return 'LazyLibrary(%r)' % self.name
+
+# Files ArduinoGC() removes from board build directories when they are
+# not targets of the build, and the file marking those directories
+GC_SUFFIXES = [ '.o', '.a', '.elf', '.hex', '.bin', '.eep', '.map', '.lst', '.d' ]
+BOARD_MARKER = '.arduino-board'
+
+# Construction variables ConfigureBoard() sets for the board; their
+# values from before the first board was configured are kept so that
+# another board can be configured in a clone (see unconfigured_clone())
+BOARD_KEYS = [ 'ARDUINO_HOME', 'BOARD', 'BOARD_NAME', 'BOARD_INFO', 'VERSION',
+               'VERSION_PATH', 'ARCH', 'F_CPU', 'M_CPU', 'VARIANT', 'CORE',
+               'BUILD_DIR', 'VARIANT_PATH', 'CORE_DIR', 'VARIANT_SYSLIB',
+               'USB_VID', 'USB_PID', 'CPPPATH', 'CFLAGS', 'CXXFLAGS' ]
+
+# Sections which size profiles leave out of the flash and RAM used: AVR
+# EEPROM, fuse, lock and signature bytes are neither program memory nor
+# RAM, although the toolchain marks them allocated and writable
+NOT_MEMORY = [ '.eeprom', '.fuse', '.lock', '.signature', '.user_signatures' ]
+
+def tool_state(env, name):
+    '''
+    Return the dictionary name from the state shared by all environments
+    in this scons run.  scons loads the tool module afresh for every
+    Environment() so module globals cannot be used for this.  Kept are
+
+      shared_builds  -- archives shared between boards, keyed by library
+                        and build fingerprint (ARDUINO_SHARE_OBJECTS)
+      include_scopes -- per board, the include paths exported by and the
+                        objects built for libraries (ARDUINO_SCOPED_INCLUDES)
+    '''
+    try:
+        state = env.fs.arduino_state
+    except AttributeError:
+        state = env.fs.arduino_state = {}
+    return state.setdefault(name, {})
+
+class RemoteCache(object):
+    '''
+    Client side of the HTTP build cache.  Entries are named by their scons
+    build signature and transferred with
+
+        GET <url>/<signature>   -- 200 and the contents, or 404
+        PUT <url>/<signature>   -- store the request body
+
+    Fetches are made by the scons job which wants the file, so with -j
+    several run at once.  Uploads are queued and sent by a pool of
+    workers.  Each thread keeps its HTTP connection open between requests.
+    '''
+
+    def __init__(self, url, workers=4):
+        parts = urlparse.urlsplit(url)
+        self.host = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stats = { 'get' : 0, 'hit' : 0, 'put' : 0,
+                       'get_bytes' : 0, 'put_bytes' : 0, 'errors' : 0 }
+        self.queue = Queue.Queue()
+        for i in range(workers):
+            t = threading.Thread(target=self.put_worker)
+            t.daemon = True
+            t.start()
+
+    def request(self, method, name, body=None):
+        for attempt in range(2):
+            conn = getattr(self.local, 'conn', None)
+            if conn is None:
+                conn = self.local.conn = httplib.HTTPConnection(self.host,
+                                                                timeout=30)
+            try:
+                conn.request(method, self.prefix + '/' + name, body)
+                response = conn.getresponse()
+                return response.status, response.read()
+            except (httplib.HTTPException, socket.error):
+                # The server may have closed a kept-alive connection
+                conn.close()
+                self.local.conn = None
+        self.count('errors', 1)
+        return None, None
+
+    def count(self, key, n):
+        with self.lock:
+            self.stats[key] += n
+
+    def fetch(self, name, path):
+        '''
+        Fetch name into the file path.  Returns True if it was found.
+        '''
+        self.count('get', 1)
+        status, data = self.request('GET', name)
+        if status != 200:
+            return False
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        tmp = '%s.%d.%s' % (path, os.getpid(), threading.current_thread().name)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+        self.count('hit', 1)
+        self.count('get_bytes', len(data))
+        return True
+
+    def store(self, name, path):
+        self.queue.put((name, path))
+
+    def put_worker(self):
+        while True:
+            name, path = self.queue.get()
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                status, body = self.request('PUT', name, data)
+                if status in [ 200, 201, 204 ]:
+                    self.count('put', 1)
+                    self.count('put_bytes', len(data))
+            except IOError:
+                self.count('errors', 1)
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        '''
+        Wait for the uploads to finish and report what was transferred
+        '''
+        self.queue.join()
+        s = self.stats
+        if s['get'] or s['put']:
+            print 'Remote cache %s: %d/%d fetched (%d bytes), %d stored (%d bytes), %d errors' % (
+                self.host, s['hit'], s['get'], s['get_bytes'], s['put'],
+                s['put_bytes'], s['errors'])
+
+class RemoteCacheDir(SCons.CacheDir.CacheDir):
+    '''
+    A CacheDir() which falls back to a RemoteCache on local misses and
+    sends everything it stores on to the RemoteCache
+    '''
+
+    def __init__(self, path, remote):
+        SCons.CacheDir.CacheDir.__init__(self, path)
+        self.remote = remote
+
+    def retrieve(self, node):
+        if self.is_enabled() and SCons.Action.execute_actions:
+            cachedir, cachefile = self.cachepath(node)
+            if not os.path.exists(cachefile):
+                self.remote.fetch(os.path.basename(cachefile), cachefile)
+        return SCons.CacheDir.CacheDir.retrieve(self, node)
+
+    def push(self, node):
+        result = SCons.CacheDir.CacheDir.push(self, node)
+        if not self.is_readonly() and self.is_enabled():
+            cachedir, cachefile = self.cachepath(node)
+            if os.path.exists(cachefile):
+                self.remote.store(os.path.basename(cachefile), cachefile)
+        return result
+
+class CacheRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Server side of the HTTP build cache; see RemoteCache.  Entries are
+    kept as files in self.server.root.
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def entry(self):
+        name = self.path.rstrip('/').split('/')[-1]
+        if not re.match(r'^[0-9A-Za-z_.-]+$', name) or name[0] == '.':
+            return None
+        return join(self.server.root, name[:2], name)
+
+    def reply(self, status, data=''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if data and self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def do_GET(self):
+        path = self.entry()
+        if path is None or not os.path.isfile(path):
+            return self.reply(404)
+        with open(path, 'rb') as f:
+            self.reply(200, f.read())
+
+    do_HEAD = do_GET
+
+    def do_PUT(self):
+        path = self.entry()
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if path is None:
+            return self.reply(400)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        tmp = '%s.%s' % (path, threading.current_thread().name)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+        self.reply(201)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class CacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    A simple HTTP build cache server storing its entries under root
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, root, host='127.0.0.1', port=8642, quiet=True):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port),
+                                           CacheRequestHandler)
+        self.root = root
+        self.quiet = quiet
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
 def exists(env):
     return 1
 
@@ -102,7 +425,10 @@ def generate(env):
     as the dictionary key.
     '''
 
-    def read_arduino_file(f, select_key=None, tab={}):
+    def read_arduino_file(f, select_key=None, tab=None):
+
+        if tab is None:
+            tab = {}
 
         # We return True if we find select_key or if select_key is None
         if select_key is None:
@@ -298,6 +624,188 @@ def generate(env):
             os.unlink(join(arduino_path, platform_dir))
 
 
+    @env.AddMethod
+    def ArduinoPackages(env, root=None):
+        '''
+        Index of the platforms and tools installed by the Boards Manager
+        under root (the Arduino15 directory holding package_*_index.json
+        and packages/).  Returns None if there is no such directory.  The
+        index is kept in .arduino-packages.json at the top of the project
+        and only rebuilt when an index file or one of the packages/*/hardware
+        or packages/*/tools directories changes.
+        '''
+        if root is None:
+            root = packages_root(env)
+        if root is None or not os.path.isdir(join(root, 'packages')):
+            return None
+        root = os.path.abspath(root)
+
+        indexes = tool_state(env, 'packages')
+        if root in indexes:
+            return indexes[root]
+
+        path = env.File('#.arduino-packages.json').abspath
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            saved = {}
+
+        entry = saved.get(root)
+        if entry is None or not stamps_match(root, entry['stamps']):
+            stamps, index = scan_packages(root)
+            saved[root] = { 'stamps' : stamps, 'index' : index }
+            try:
+                with open(path, 'w') as f:
+                    json.dump(saved, f, indent=1, sort_keys=True)
+            except IOError:
+                pass
+        else:
+            index = entry['index']
+
+        indexes[root] = index
+        return index
+
+    def packages_root(env):
+        '''
+        The Boards Manager directory: $ARDUINO_PACKAGES if set, else the one
+        $ARDUINO_HOME is within, else the usual per user location
+        '''
+        root = env.get('ARDUINO_PACKAGES', os.environ.get('ARDUINO_PACKAGES'))
+        if root:
+            return env.subst(root)
+        home = os.path.normpath(env.subst('$ARDUINO_HOME'))
+        if os.path.basename(os.path.dirname(home)) == 'packages':
+            return os.path.dirname(os.path.dirname(home))
+        if os.path.isdir(join(home, 'packages')):
+            return home
+        if sys.platform == 'darwin':
+            root = join(os.path.expanduser('~'), 'Library', 'Arduino15')
+        elif sys.platform == 'win32':
+            root = join(os.environ.get('LOCALAPPDATA', ''), 'Arduino15')
+        else:
+            root = join(os.path.expanduser('~'), '.arduino15')
+        if os.path.isdir(root):
+            return root
+        return None
+
+    def package_stamps(root):
+        '''
+        Modification times of the index files and of the directories
+        whose entries are the installed packages, platforms and versions
+        '''
+        stamps = {}
+        for name in os.listdir(root):
+            if name.startswith('package_') and name.endswith('index.json'):
+                stamps[join(root, name)] = os.path.getmtime(join(root, name))
+        packages = join(root, 'packages')
+        stamps[packages] = os.path.getmtime(packages)
+        for packager in os.listdir(packages):
+            for kind in [ 'hardware', 'tools' ]:
+                d = join(packages, packager, kind)
+                if not os.path.isdir(d):
+                    continue
+                stamps[d] = os.path.getmtime(d)
+                for name in os.listdir(d):
+                    if os.path.isdir(join(d, name)):
+                        stamps[join(d, name)] = os.path.getmtime(join(d, name))
+        return stamps
+
+    def stamps_match(root, stamps):
+        try:
+            return package_stamps(root) == stamps
+        except OSError:
+            return False
+
+    def scan_packages(root):
+        '''
+        Walk packages/<packager>/{hardware,tools}/<name>/<version> and read
+        the tool dependencies of each platform from the index files.
+        Platforms and tools are keyed by "packager/name/version".
+        '''
+        stamps = package_stamps(root)
+        index = { 'platforms' : {}, 'tools' : {} }
+        packages = join(root, 'packages')
+        for packager in sorted(os.listdir(packages)):
+            for kind in [ 'hardware', 'tools' ]:
+                d = join(packages, packager, kind)
+                if not os.path.isdir(d):
+                    continue
+                for name in sorted(os.listdir(d)):
+                    if not os.path.isdir(join(d, name)):
+                        continue
+                    for ver in sorted(os.listdir(join(d, name))):
+                        path = join(d, name, ver)
+                        if not os.path.isdir(path):
+                            continue
+                        key = '/'.join([ packager, name, ver ])
+                        if kind == 'tools':
+                            index['tools'][key] = path
+                        else:
+                            index['platforms'][key] = { 'packager' : packager,
+                                'arch' : name, 'version' : ver, 'path' : path,
+                                'tools' : None }
+
+        for f in sorted(stamps.keys()):
+            if not f.endswith('.json'):
+                continue
+            try:
+                with open(f) as fd:
+                    packs = json.load(fd).get('packages', [])
+            except (IOError, ValueError):
+                continue
+            for pack in packs:
+                for plat in pack.get('platforms', []):
+                    key = '/'.join([ pack.get('name', ''),
+                        plat.get('architecture', ''), plat.get('version', '') ])
+                    if key in index['platforms']:
+                        index['platforms'][key]['tools'] = [
+                            [ t['packager'], t['name'], t['version'] ]
+                            for t in plat.get('toolsDependencies', []) ]
+        return stamps, index
+
+    def version_key(version):
+        return [ int(v) if v.isdigit() else v for v in re.split(r'[.-]', version) ]
+
+    def find_platform(index, arch, version_path, arch_path=None):
+        '''
+        The installed platform for arch at arch_path, or, without
+        arch_path, the installed platform of the requested version
+        '''
+        if index is None:
+            return None
+        for p in index['platforms'].values():
+            if p['arch'] != arch:
+                continue
+            if arch_path is None:
+                if p['version'] == version_path:
+                    return p
+            elif os.path.normpath(p['path']) == os.path.normpath(arch_path):
+                return p
+        return None
+
+    def platform_tools(index, platform):
+        '''
+        Map tool names (also name-version) to the tool directories the
+        platform depends upon.  Without an index file naming them, the
+        newest installed version of each of the packager's tools is used.
+        '''
+        paths = {}
+        deps = platform['tools']
+        if deps is None:
+            deps = []
+            for key in index['tools']:
+                packager, name, ver = key.split('/')
+                if packager == platform['packager']:
+                    deps.append([ packager, name, ver ])
+            deps.sort(key=lambda t: version_key(t[2]))
+        for packager, name, ver in deps:
+            key = '/'.join([ packager, name, ver ])
+            if key in index['tools']:
+                paths[name] = index['tools'][key]
+                paths[name + '-' + ver] = index['tools'][key]
+        return paths
+
     @env.AddMethod
     def ConfigureBoard(env, version, arch, board, options=None):
 
@@ -305,6 +813,12 @@ def generate(env):
         Configure this environment for the given board name. Available boards
         are listed in $ARDUINO_HOME/hardware/arduino/$ARDUINO_ARCH/boards.txt
         '''
+        started = time.time()
+
+        if not ('ARDUINO_UNCONFIGURED' in env):
+            env['ARDUINO_UNCONFIGURED'] = dict([
+                (key, SCons.Util.semi_deepcopy(env[key]))
+                for key in BOARD_KEYS if key in env ])
 
         env.SetDefault(
             ARDUINO_HOME = os.environ.get("ARDUINO_HOME", "/usr/share/arduino"))
@@ -319,6 +833,28 @@ def generate(env):
             version = int(version)
 
         version_path = '%d.%d.%d' % (version / 100, (version % 100) / 10, version % 10)
+        platform = None
+        if (arch != 'avr') and (version >= 160):
+            # Boards Manager install: packages/<packager>/hardware/<arch>/<version>
+            arch_path = join(env.subst('$ARDUINO_HOME'), 'hardware', arch, version_path)
+            if os.path.isdir(arch_path):
+                # Use the platform in ARDUINO_HOME; the index only supplies
+                # its tool chain, if ARDUINO_TOOLS does not
+                if not ('ARDUINO_TOOLS' in os.environ):
+                    index = env.ArduinoPackages()
+                    platform = find_platform(index, arch, version_path, arch_path)
+            else:
+                index = env.ArduinoPackages()
+                platform = find_platform(index, arch, version_path)
+                if not (index is None) and platform is None:
+                    installed = sorted([ p['version'] for p in index['platforms'].values()
+                                         if p['arch'] == arch ], key=version_key)
+                    raise Exception('Arduino %s %s is not installed in %s nor by the Boards Manager (installed: %s)' % (
+                        arch, version_path, env.subst('$ARDUINO_HOME'),
+                        ', '.join(installed) or 'none'))
+                if not (platform is None):
+                    env['ARDUINO_HOME'] = os.path.dirname(os.path.dirname(
+                        os.path.dirname(platform['path'])))
         if (arch != 'avr') and (version >= 160):
             hardware_path = join(env.subst('$ARDUINO_HOME'), 'hardware')
             arduino_path  = join(hardware_path, arch)
@@ -337,7 +873,12 @@ def generate(env):
         # split('a/b') --> 'a', 'b'
 
         build_dir, platform_dir = os.path.split(variant_dir)
-        if platform_dir != '':
+        scoped = env.get('ARDUINO_SCOPED_REPOSITORY')
+        if platform_dir != '' and not scoped:
+            # When scoped, the core and library sources are named by their
+            # absolute paths in the Arduino install: no links are made, and
+            # those of any unscoped board directory of the same name are
+            # left alone
 
             env.CleanupBoard(version, arch, board)
 
@@ -350,7 +891,8 @@ def generate(env):
                 os.symlink(arch_path, join(arduino_path, platform_dir))
 
         # Repository() so that we do not drop .o files in the actual Arduino app directories
-        Repository(hardware_path)
+        if not scoped:
+            Repository(hardware_path)
 
         # Read the boards.txt and platform.txt files
         try:
@@ -370,9 +912,13 @@ def generate(env):
         info['build.arch.path'] = arch.lower()
 
         if (arch != 'avr') and (version >= 160):
-            if not ('ARDUINO_TOOLS' in os.environ):
+            if not (platform is None):
+                for name, path in platform_tools(index, platform).items():
+                    info['runtime.tools.' + name + '.path'] = path
+            if 'ARDUINO_TOOLS' in os.environ:
+                info['runtime.tools.arm-none-eabi-gcc.path'] = os.environ['ARDUINO_TOOLS']
+            elif not ('runtime.tools.arm-none-eabi-gcc.path' in info):
                 raise Exception('ARDUINO_TOOLS not defined in environment')
-            info['runtime.tools.arm-none-eabi-gcc.path'] = os.environ['ARDUINO_TOOLS']
             info['build.system.path'] = '$ARDUINO_HOME/hardware/' + \
                 '{build.arch.path}/' + version_path + '/system'
             info['build.variant.path'] = '$ARDUINO_HOME/hardware/' + \
@@ -409,7 +955,7 @@ def generate(env):
         setInfo(info, 'cmd.path', 'tools.' + prog + '.cmd.path')
         setInfo(info, 'config.path', 'tools.' + prog + '.config.path')
         if not setInfo(info, 'path', 'tools.' + prog + '.path'):
-            info['path'] = join(env.subst('$ARDUINO_HOME', 'hardware', 'tools'))
+            info['path'] = join(env.subst('$ARDUINO_HOME'), 'hardware', 'tools')
 
         # Needed for Arduino 1.6
         if not ('runtime.tools.bossac.path' in info):
@@ -523,6 +1069,37 @@ def generate(env):
             CORE         = info['build.core'],
             BUILD_DIR    = join(build_dir, '$BOARD') )
 
+        # Keep a compact record of the board rather than the info table;
+        # the table is large and is of no further use once we're done here
+        env['BOARD_INFO'] = BoardInfo(
+            board              = board,
+            name               = info['build.board'],
+            version            = version,
+            version_path       = version_path,
+            arch               = arch,
+            f_cpu              = info['build.f_cpu'],
+            mcu                = info['build.mcu'],
+            variant            = info['build.variant'],
+            core               = info['build.core'],
+            vid                = vid,
+            pid                = pid,
+            variant_system_lib = info.get('build.variant_system_lib'),
+            hardware_path      = hardware_path,
+            arduino_path       = arduino_path,
+            arch_path          = arch_path )
+
+        if platform_dir != '':
+            # Note the board directory and links made for ArduinoGC()
+            links = []
+            if not scoped:
+                links.append(join(arduino_path, platform_dir))
+                if build_dir != '':
+                    links.append(join(hardware_path, build_dir))
+            path = env.Dir(variant_dir, env.Dir('#')).abspath
+            tool_state(env, 'board_dirs')[path] = (env['BOARD_INFO'], links)
+            if tool_state(env, 'gc').get('enabled'):
+                mark_board_dir(path)
+
         if (arch != 'avr') and (version >= 160):
             env.SetDefault(
                 VARIANT_PATH = join('$ARDUINO_HOME', 'hardware',
@@ -631,7 +1208,9 @@ def generate(env):
             s = s.replace('{object_files}', '$SOURCES')
             s = s.replace('"{build.path}/{archive_file}"', '')
             s = s.replace('{build.path}/{archive_file}', '')
-            env.Append( BUILDERS = { 'Elf' : Builder(action=s) } )
+            env.Replace( ELFCOM = s )
+            env.Append( BUILDERS = { 'Elf' : Builder(action='$ELFCOM',
+                                                     emitter=elf_emitter) } )
 
         if (arch != 'avr') and (version >= 160):
             pattern = 'recipe.objcopy.bin.pattern'
@@ -647,7 +1226,8 @@ def generate(env):
             s = s.replace('{build.path}/{build.project_name}.bin',   '$TARGET')
             s = s.replace('"{build.path}/{build.project_name}.hex"', '$TARGET')
             s = s.replace('{build.path}/{build.project_name}.hex',   '$TARGET')
-            env.Append( BUILDERS = { 'Hex' : Builder(action=s, suffix='.hex', src_suffix='.elf') } )
+            env.Append( BUILDERS = { 'Hex' : Builder(action=s, suffix='.hex', src_suffix='.elf',
+                                                     emitter=artifact_emitter) } )
 
         if 'recipe.S.o.pattern' in info:
             s = info['recipe.S.o.pattern']
@@ -669,6 +1249,173 @@ def generate(env):
             s = s.replace('{build.path}/{build.project_name}.bin',   '$SOURCES')
             env.Replace( UPLOAD = s )
 
+        # Note how long configuring the board took for BuildTrends()
+        configured = tool_state(env, 'configured')
+        info, seconds = configured.get(board, (None, 0.0))
+        configured[board] = (env['BOARD_INFO'], seconds + time.time() - started)
+        return env
+
+    def batch_builder(com, suffixes):
+        '''
+        An object builder whose compiles are batched: with
+        ARDUINO_BATCH_COMPILE set, objects built from the same
+        environment into the same directory are compiled up to
+        ARDUINO_BATCH_COMPILE (8 if just True) at a time by one compiler
+        run.  Each object keeps its own dependencies; when any of a
+        batch's objects is out of date, the whole batch is compiled.
+        '''
+        def key(action, env, target, source):
+            # scons rebinds this as a method of the action, dropping any
+            # closure, so the counts are kept on the action
+            size = env.get('ARDUINO_BATCH_COMPILE')
+            if size is True or not (type(size) is int) or size < 1:
+                size = 8
+            counts = action.__dict__.setdefault('arduino_batch_counts', {})
+            group = (id(action), id(env), target[0].dir)
+            n = counts.get(group, 0)
+            counts[group] = n + 1
+            return group + (n / size,)
+
+        # gcc puts the objects of a multi-source compile into the current
+        # directory, so batches are compiled from the objects' directory
+        # (scons quotes the directory if it holds spaces)
+        com = 'cd ${TARGET.dir.abspath} && ' + com
+        return Builder(action=SCons.Action.Action(com, batch_key=key),
+                       suffix='$OBJSUFFIX', src_suffix=suffixes,
+                       source_scanner=SCons.Tool.SourceFileScanner)
+
+    def absolute_dirs(paths):
+        '''
+        Like RDirs (see _CPPINCFLAGS) but as absolute paths, for commands
+        run from another directory
+        '''
+        dirs = rdirs(paths)
+        if dirs is None:
+            return None
+        return [ d.abspath if isinstance(d, SCons.Node.Node) else d for d in dirs ]
+
+    rdirs = SCons.Defaults.Variable_Method_Caller('TARGET', 'RDirs')
+
+    # The batch compile commands are $CCCOM and $CXXCOM without -o, run
+    # from the objects' directory; DistributedCompile() and
+    # UseResponseFiles() wrap them just as they do those
+    env.SetDefault(
+        _ARDUINO_ABSDIRS = absolute_dirs,
+        _ARDUINO_ABSINCFLAGS = '$( ${_concat(INCPREFIX, CPPPATH, INCSUFFIX, __env__, _ARDUINO_ABSDIRS, TARGET, SOURCE)} $)',
+        ARDUINO_BATCHCCCOM = '$CC -c $CFLAGS $CCFLAGS $CPPFLAGS $_CPPDEFFLAGS ' +
+            '$_ARDUINO_ABSINCFLAGS ${SOURCES.abspath}',
+        ARDUINO_BATCHCXXCOM = '$CXX -c $CXXFLAGS $CCFLAGS $CPPFLAGS $_CPPDEFFLAGS ' +
+            '$_ARDUINO_ABSINCFLAGS ${SOURCES.abspath}' )
+    env.Append( BUILDERS = {
+        'ArduinoBatchC'   : batch_builder('$ARDUINO_BATCHCCCOM', [ '.c' ]),
+        'ArduinoBatchCXX' : batch_builder('$ARDUINO_BATCHCXXCOM', [ '.cpp', '.cc', '.cxx' ]) } )
+
+    def compile_sources(env, sources, batch=True):
+        '''
+        Objects for sources, batched (see batch_builder()) if batch is true
+        and ARDUINO_BATCH_COMPILE is set.  Sources found in the Arduino
+        install (see install_path()) have their objects placed at the same
+        relative path in the board's build directory.
+        '''
+        batch = batch and env.get('ARDUINO_BATCH_COMPILE')
+        scoped = env.get('ARDUINO_SCOPED_REPOSITORY')
+        if not (batch or scoped):
+            return env.Object(sources)
+        objs = []
+        for s in env.Flatten([ sources ]):
+            suffix = os.path.splitext(str(s))[1]
+            target = install_target(env, s) if scoped else None
+            if batch and suffix == '.c':
+                objs += env.ArduinoBatchC(target, s)
+            elif batch and suffix in [ '.cpp', '.cc', '.cxx' ]:
+                objs += env.ArduinoBatchCXX(target, s)
+            else:
+                objs += env.Object(target, s)
+        return objs
+
+    def install_path(env, path):
+        '''
+        With ARDUINO_SCOPED_REPOSITORY, the absolute path in the Arduino
+        install of path, a path relative to the board's platform directory
+        such as cores/$CORE.  Otherwise, or when the install has no such
+        path, path is returned unchanged and is found by way of the
+        Repository() ConfigureBoard() declares.
+        '''
+        if not env.get('ARDUINO_SCOPED_REPOSITORY'):
+            return path
+        full = join(env['BOARD_INFO'].arch_path, env.subst(path))
+        if os.path.exists(full):
+            return full
+        return path
+
+    def install_target(env, source):
+        '''
+        Object file for a source from the Arduino install: the source's path
+        relative to the platform directory, in the board's build directory
+        '''
+        return object_target(env, source, env['BOARD_INFO'].arch_path)
+
+    def object_target(env, source, root, target_dir=''):
+        '''
+        Object file for a source lying under the directory root: the
+        source's path relative to root, within target_dir.  None if the
+        source is not under root.
+        '''
+        path = env.File(source).abspath
+        if not path.startswith(root + os.sep):
+            return None
+        return join(target_dir, os.path.splitext(path[len(root) + 1:])[0]) + \
+            env.subst('$OBJSUFFIX')
+
+    @env.AddMethod
+    def RepositoryProbeReport(env):
+        '''
+        Count the filesystem probes scons makes on behalf of Repository()
+        and print them when scons exits.  Call this ahead of ConfigureBoard()
+        so that the probes made while reading the SConscripts are counted.
+
+        Two figures are kept: the repository directories handed to node
+        lookups which did not find their file locally (each is a potential
+        probe; scons stops at the first hit) and the directories listed
+        on disk, split into those within and outside of a repository.
+        '''
+        probes = tool_state(env, 'repository_probes')
+        if len(probes) > 0:
+            return env
+        probes.update(lookups = 0, repository_dirs = 0, listings = 0,
+                      repository_listings = 0)
+        repositories = set()
+
+        fs_dir = SCons.Node.FS.Dir
+        get_all_rdirs = fs_dir.get_all_rdirs
+        entry_exists_on_disk = fs_dir.entry_exists_on_disk
+
+        def counted_get_all_rdirs(self):
+            result = get_all_rdirs(self)
+            if len(result) > 1:
+                probes['lookups'] += 1
+                probes['repository_dirs'] += len(result) - 1
+                for rdir in result[1:]:
+                    repositories.add(rdir)
+            return result
+
+        def counted_entry_exists_on_disk(self, name):
+            if not hasattr(self, 'on_disk_entries'):
+                probes['listings'] += 1
+                if self in repositories:
+                    probes['repository_listings'] += 1
+            return entry_exists_on_disk(self, name)
+
+        fs_dir.get_all_rdirs = counted_get_all_rdirs
+        fs_dir.entry_exists_on_disk = counted_entry_exists_on_disk
+
+        def report():
+            print 'Repository probes: %d lookups went through %d repository directories' % \
+                (probes['lookups'], probes['repository_dirs'])
+            print 'Directory listings: %d, %d of them in repositories' % \
+                (probes['listings'], probes['repository_listings'])
+
+        atexit.register(report)
         return env
 
     @env.AddMethod
@@ -679,66 +1426,296 @@ def generate(env):
         version = int(env.subst('$VERSION'))
         arch = env.subst('$ARDUINO_ARCH').lower()
         if (arch != 'avr') and (version >= 160):
-            env.Append ( CPPPATH = [ join('$ARDUINO_HOME', 'hardware',
-                                          '$ARDUINO_ARCH', '$VERSION_PATH',
-                                          'system', 'libsam', 'include') ] )
+            includes = [ join('$ARDUINO_HOME', 'hardware', '$ARDUINO_ARCH',
+                              '$VERSION_PATH', 'system', 'libsam', 'include') ]
         else:
-            env.Append ( CPPPATH = [ join('$ARDUINO_HOME', 'hardware',
-                                          'arduino', '$ARDUINO_ARCH',
-                                          'system', 'libsam', 'include') ] )
-        if arch == 'avr':
+            includes = [ join('$ARDUINO_HOME', 'hardware', 'arduino',
+                              '$ARDUINO_ARCH', 'system', 'libsam', 'include') ]
+        env = add_includes(env, includes)
 
-            # Arduino AVR core library has two identically named source files,
-            #   wiring_pulse.c
-            #   wiring_pulse.S
-            # This causes grief as normally scons wants to call the objects
-            # wiring_pulse.o and wiring_pulse.o.  So, we need to address that...
+        def build(env):
+            if arch == 'avr':
 
-            c_objs = env.Object(cfiles(env, 'cores/$CORE'))
-            asm_objs = env.Object(source='cores/$CORE/wiring_pulse.S',
-                                  target='cores/$CORE/wiring_pulse.S.o')
-            return env.Clone().Library("arduino-core", [ c_objs, asm_objs ])
+                # Arduino AVR core library has two identically named source files,
+                #   wiring_pulse.c
+                #   wiring_pulse.S
+                # This causes grief as normally scons wants to call the objects
+                # wiring_pulse.o and wiring_pulse.o.  So, we need to address that...
 
-        else:
+                c_objs = compile_sources(env, cfiles(env, 'cores/$CORE'))
+                asm_objs = env.Object(source=install_path(env, 'cores/$CORE/wiring_pulse.S'),
+                                      target='cores/$CORE/wiring_pulse.S.o')
+                core = env.Clone().Library("arduino-core", [ c_objs, asm_objs ])
+
+            else:
+
+                srcfiles = cfiles(env, 'cores/$CORE') + \
+                    cfiles(env, 'cores/$CORE/avr') + \
+                    cfiles(env, 'cores/$CORE/USB') + \
+                    cfiles(env, 'variants/$VARIANT')
+                if env.get('ARDUINO_BATCH_COMPILE') or \
+                        env.get('ARDUINO_SCOPED_REPOSITORY'):
+                    srcfiles = compile_sources(env, srcfiles)
+                core = env.Clone().Library("arduino-core", srcfiles)
+
+            return export_includes(env, core, includes)
 
-            srcfiles = cfiles(env, 'cores/$CORE') + \
-                cfiles(env, 'cores/$CORE/avr') + \
-                cfiles(env, 'cores/$CORE/USB') + \
-                cfiles(env, 'variants/$VARIANT')
-            return env.Clone().Library("arduino-core", srcfiles)
+        return shared_build(env, 'arduino-core', build)
 
     def cfiles(env, path):
         '''
         Identify source files, .c, .cpp, and .S
         '''
-        return env.Glob(join(path, '*.c')) + env.Glob(join(path, '*.cpp'))
+        path = install_path(env, path)
+        files = env.Glob(join(path, '*.c')) + env.Glob(join(path, '*.cpp'))
+        if env.get('ARDUINO_REPRODUCIBLE'):
+            files.sort(key=lambda f: os.path.basename(str(f)))
+        return files
 
     @env.AddMethod
-    def ArduinoLibrary(env, name, path=None):
+    def ArduinoLibrary(env, name, path=None, libs=None):
         '''
         Build a library. If path is not given, it is assumed to be a builtin
         arduino library. This adds the path to the inclide path, and builds
         all .c and .cpp files from path and path/utility into a library.
+
+        libs lists the archives of other libraries whose headers this
+        library includes.  It is only needed with ARDUINO_SCOPED_INCLUDES.
+
+        With ARDUINO_LAZY_LIBRARIES set, a LazyLibrary is returned instead
+        and all of the above waits until Sketch() or Elf() links it.  The
+        include paths are then added to env as it is at that point.
+        '''
+        if env.get('ARDUINO_LAZY_LIBRARIES'):
+            return LazyLibrary(name, lambda: declare_library(env, name, path, libs))
+        return declare_library(env, name, path, libs)
+
+    def declare_library(env, name, path, libs):
+        path, includes = library_includes(env, name, path)
+        lib_env = add_includes(env, includes + env.LibraryIncludes(libs))
+
+        def build(env):
+            sources = library_sources(env, name, path)
+            if env.get('ARDUINO_BATCH_LIBRARIES') or \
+                    env.get('ARDUINO_SCOPED_REPOSITORY'):
+                sources = compile_sources(env, sources,
+                                          env.get('ARDUINO_BATCH_LIBRARIES'))
+            lib = env.Clone().Library(path, sources)
+            return export_includes(env, lib, includes)
+
+        return shared_build(lib_env, path, build)
+
+    @env.AddMethod
+    def ArduinoLibraries(env, libraries):
+        '''
+        Build several libraries at once.  libraries is a list whose entries
+        are either a library name or a (name, path) tuple as would be passed
+        to ArduinoLibrary().  The include paths of all the libraries are
+        added to CPPPATH in one go and the libraries are then all built from
+        a single cloned environment.
+
+        The archives are returned in the order given.  List libraries ahead
+        of the libraries which they use so that the result is in link order.
+        '''
+        libs = []
+        includes = []
+        for lib in libraries:
+            if type(lib) is tuple:
+                name, path = lib
+            else:
+                name, path = lib, None
+            path, incs = library_includes(env, name, path)
+            libs.append((name, path, incs))
+            includes += incs
+
+        lib_env = add_includes(env, includes, unique=True)
+        if lib_env is env:
+            lib_env = env.Clone()
+
+        archives = []
+        for name, path, incs in libs:
+            def build(env):
+                sources = library_sources(env, name, path)
+                if env.get('ARDUINO_BATCH_LIBRARIES') or \
+                        env.get('ARDUINO_SCOPED_REPOSITORY'):
+                    sources = compile_sources(env, sources,
+                                              env.get('ARDUINO_BATCH_LIBRARIES'))
+                lib = env.Library(path, sources)
+                return export_includes(env, lib, incs)
+            archives += shared_build(lib_env, path, build)
+        return archives
+
+    @env.AddMethod
+    def LibraryIncludes(env, libs):
+        '''
+        With ARDUINO_SCOPED_INCLUDES, return the include paths needed to use
+        the given core and library archives.  For example,
+
+            env.Object('foo.cpp',
+                       CPPPATH = env['CPPPATH'] + env.LibraryIncludes(libs))
+
+        Otherwise, those paths are already in CPPPATH and [] is returned.
+        '''
+        includes = []
+        for node in realize_libraries(env, libs or []):
+            if is_scoped_library(node):
+                includes += node.attributes.arduino_includes
+        return unique(includes)
+
+    def shared_build(env, name, build):
+        '''
+        When ARDUINO_SHARE_OBJECTS is set, boards which would compile the
+        core or a library identically share a single build of it: the
+        first board to ask calls build() and later boards with the same
+        build fingerprint are handed the same archive.  Otherwise, this
+        just calls build(env).
+
+        A shared build is done from a clone of env.  Include paths added
+        to env afterwards (e.g., by ArduinoLibrary()) would otherwise make
+        the fingerprint wrong.
+        '''
+        if not env.get('ARDUINO_SHARE_OBJECTS'):
+            return register_artifacts(env, build(env))
+        env = env.Clone()
+        key = (env.subst(name), build_fingerprint(env))
+        shared = tool_state(env, 'shared_builds')
+        if not (key in shared):
+            shared[key] = register_artifacts(env, build(env))
+        return shared[key]
+
+    def register_artifacts(env, nodes):
+        '''
+        Note the archives, ELF and hex files built for the board.  Objects
+        are found later from the sources of these.
+        '''
+        artifacts = tool_state(env, 'artifacts')
+        board = env.subst('$BOARD')
+        for node in nodes:
+            artifacts.setdefault(node, board)
+        return nodes
+
+    def artifact_emitter(target, source, env):
+        register_artifacts(env, target)
+        return target, source
+
+    def artifact_kind(node):
+        return { '.o'   : 'object',
+                 '.a'   : 'archive',
+                 '.elf' : 'elf',
+                 '.hex' : 'hex',
+                 '.bin' : 'hex' }.get(os.path.splitext(str(node))[1], 'other')
+
+    def board_artifacts(env):
+        '''
+        Return a dictionary mapping every file built for a board by this
+        tool -- objects, archives, ELF and hex files -- to the board
+        '''
+        result = {}
+        for node, board in tool_state(env, 'artifacts').items():
+            result.setdefault(node, board)
+            for obj in node.sources:
+                if obj.has_builder() and artifact_kind(obj) == 'object':
+                    result.setdefault(obj, board)
+        return result
+
+    def build_fingerprint(env):
+        '''
+        Hash of everything which goes into compiling and archiving a
+        library: the compile and archive commands with all their flags,
+        include paths and defines, and the core and variant used.  Text
+        matching the regular expressions in ARDUINO_SHARE_IGNORE (e.g.,
+        r'-DARDUINO_AVR_\w+') is disregarded.
+        '''
+        text = env.subst('$CCCOM\n$CXXCOM\n$ASCOM\n$ARCOM\n' +
+                         '$CORE_DIR\n$CORE\n$VARIANT_PATH')
+        for pattern in env.get('ARDUINO_SHARE_IGNORE', []):
+            text = re.sub(pattern, '', text)
+        return hashlib.md5(text).hexdigest()
+
+    def add_includes(env, includes, unique=False):
+        '''
+        Add include paths needed to build a library.  Normally they are
+        added to env itself and everything built with env then sees them.
+        When ARDUINO_SCOPED_INCLUDES is set, they are instead added to a
+        clone of env which is returned for building just the library.
+        '''
+        if env.get('ARDUINO_SCOPED_INCLUDES'):
+            env = env.Clone()
+            env.AppendUnique(CPPPATH = includes)
+        elif unique:
+            env.AppendUnique(CPPPATH = includes)
+        else:
+            env.Append(CPPPATH = includes)
+        return env
+
+    def export_includes(env, archives, includes):
+        '''
+        Note on the archive nodes which include paths users of the archive
+        need.  Only done with ARDUINO_SCOPED_INCLUDES.
+        '''
+        if env.get('ARDUINO_SCOPED_INCLUDES'):
+            scope = include_scope(env)
+            for node in archives:
+                node.attributes.arduino_includes = list(includes)
+                scope['objects'] += node.sources
+            scope['dirs'].update([ env.subst(i) for i in includes ])
+        return archives
+
+    def realize_libraries(env, sources):
+        '''
+        Flatten sources, replacing each LazyLibrary with its archives
+        '''
+        result = []
+        for s in env.Flatten([ sources ]):
+            if isinstance(s, LazyLibrary):
+                result += s.realize()
+            else:
+                result.append(s)
+        return result
+
+    def elf_emitter(target, source, env):
+        profile_sizes(env, target)
+        return artifact_emitter(target, realize_libraries(env, source), env)
+
+    def is_scoped_library(node):
+        return hasattr(getattr(node, 'attributes', None), 'arduino_includes')
+
+    def include_scope(env):
+        return tool_state(env, 'include_scopes').setdefault(
+            env.subst('$BOARD'), { 'dirs' : set(), 'objects' : [] })
+
+    def unique(items):
+        seen = set()
+        result = []
+        for item in items:
+            if not (item in seen):
+                seen.add(item)
+                result.append(item)
+        return result
+
+    def library_includes(env, name, path):
+        '''
+        Return the library's source path and the include paths it needs
         '''
-        full_name = join('$BUILD_DIR', 'libraries', name)
         path = path or join('libraries', name)
         version = int(env.subst('$VERSION'))
         arch = env.subst('$ARDUINO_ARCH').lower()
         if (arch != 'avr') and (version >= 160):
-            env.Append(CPPPATH = [ join('$ARDUINO_HOME', 'hardware',
-                                        '$ARDUINO_ARCH', '$VERSION_PATH',
-                                        path) ] )            
+            includes = [ join('$ARDUINO_HOME', 'hardware', '$ARDUINO_ARCH',
+                              '$VERSION_PATH', path) ]
         else:
-            env.Append(CPPPATH = [ join('$ARDUINO_HOME', 'hardware', 'arduino',
-                                        '$ARDUINO_ARCH', path) ] )
+            includes = [ join('$ARDUINO_HOME', 'hardware', 'arduino',
+                              '$ARDUINO_ARCH', path) ]
             if name == 'Wire':
-                env.Append(CPPPATH = [ join('$ARDUINO_HOME', 'hardware',
-                                            'arduino', '$ARDUINO_ARCH',
-                                            path, 'utility') ] )
+                includes.append(join('$ARDUINO_HOME', 'hardware', 'arduino',
+                                     '$ARDUINO_ARCH', path, 'utility'))
+        return path, includes
+
+    def library_sources(env, name, path):
         sources = cfiles(env, path)
-        if (name == 'Wire') and (arch == 'avr'):
+        if (name == 'Wire') and (env.subst('$ARDUINO_ARCH').lower() == 'avr'):
             sources += cfiles(env, join(path, 'utility'))
-        return env.Clone().Library(path, sources)
+        return sources
 
     @env.AddMethod
     def Sketch(env, name, sources):
@@ -746,9 +1723,561 @@ def generate(env):
         Build a program from sources, and copy the resulting elf file into a hex
         file for uploading.
         '''
-        elf = env.Program(name, sources, PROGSUFFIX = '.elf')
+        sources = realize_libraries(env, sources)
+        if env.get('ARDUINO_SCOPED_INCLUDES'):
+            # Compile the sketch sources seeing only the include paths of
+            # the libraries linked with it
+            libs = [ s for s in sources if is_scoped_library(s) ]
+            others = [ s for s in sources if not (s in libs) ]
+            srcs = [ s for s in others if is_source(s) ]
+            objs = env.Object(srcs, CPPPATH = unique(
+                    env.get('CPPPATH', []) + env.LibraryIncludes(libs)))
+            include_scope(env)['objects'] += objs
+            sources = objs + [ s for s in others if not (s in srcs) ] + libs
+
+        sources = env.Flatten([ sources ])
+        inos = [ s for s in sources if str(s).endswith('.ino') ]
+        if len(inos) > 0:
+            # The sketch object goes ahead of any archives it links with
+            libs = [ s for s in sources if is_scoped_library(s) ]
+            sources = sketch_object(env, name, inos, libs) + \
+                [ s for s in sources if not (s in inos) ]
+
+        elf = register_artifacts(env, env.Program(name, sources, PROGSUFFIX = '.elf'))
+        profile_sizes(env, elf)
         return env.Hex(name, elf)
 
+    def is_source(node):
+        return os.path.splitext(str(node))[1] in [ '.c', '.cpp', '.cc', '.cxx', '.S' ]
+
+    def sketch_object(env, name, inos, libs=None):
+        '''
+        Preprocess .ino files the way the Arduino IDE does, into name.ino.cpp
+        and a header name.ino.h of function prototypes, and compile the
+        former.  The main .ino (name.ino) comes first, then the others in
+        alphabetical order.  With ARDUINO_SCOPED_INCLUDES, the include paths
+        of the libraries libs are added for the compile.
+        '''
+        if libs is None:
+            libs = []
+        inos = [ env.File(s) for s in inos ]
+        main = [ s for s in inos if s.name == os.path.basename(name) + '.ino' ]
+        inos = main + sorted([ s for s in inos if not (s in main) ],
+                             key=lambda s: s.name)
+        cpp, header = env.Command([ name + '.ino.cpp', name + '.ino.h' ], inos,
+            SCons.Action.Action(preprocess_ino, 'Preprocessing sketch $TARGET'))
+        # Keep the previous output for preprocess_ino to compare against
+        env.Precious(cpp, header)
+        # Headers next to the .ino files are included as "foo.h"
+        dirs = unique([ s.srcnode().dir for s in inos ])
+        objs = env.Object(cpp, CPPPATH = unique(
+                dirs + env.get('CPPPATH', []) + env.LibraryIncludes(libs)))
+        include_scope(env)['objects'] += objs
+        return objs
+
+    def preprocess_ino(target, source, env):
+        '''
+        Concatenate the .ino sources into target[0], including Arduino.h and,
+        ahead of the first function definition, the prototypes written to
+        target[1].  Either file is only rewritten when its contents change,
+        so editing a function body leaves the prototype header untouched.
+        '''
+        cpp, header = target
+        text = [ '#include <Arduino.h>\n' ]
+        prototypes = []
+        for src in source:
+            contents = src.rfile().get_text_contents()
+            path = src.rfile().abspath.replace('\\', '/')
+            found = ino_prototypes(contents)
+            lines = contents.splitlines(True)
+            if len(found) > 0 and len(prototypes) == 0:
+                first = found[0][0]
+                text.append('#line 1 "%s"\n' % path)
+                text += lines[:first]
+                text.append('#include "%s"\n' % header.name)
+                text.append('#line %d "%s"\n' % (first + 1, path))
+                text += lines[first:]
+            else:
+                text.append('#line 1 "%s"\n' % path)
+                text += lines
+            if len(lines) > 0 and not lines[-1].endswith('\n'):
+                text.append('\n')
+            prototypes += [ p for line, p in found ]
+
+        proto = [ '// Prototypes generated from %s\n' %
+                  ', '.join([ s.name for s in source ]) ]
+        proto += [ p + ';\n' for p in prototypes ]
+        write_if_changed(header.abspath, ''.join(proto))
+        write_if_changed(cpp.abspath, ''.join(text))
+        return 0
+
+    def write_if_changed(path, contents):
+        try:
+            with open(path, 'r') as f:
+                if f.read() == contents:
+                    return
+        except IOError:
+            pass
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def strip_ino(text):
+        '''
+        Blank out comments, string and character literals, and preprocessor
+        lines, keeping every newline so that offsets map to the same lines
+        '''
+        blank = lambda m: re.sub(r'[^\n]', ' ', m.group(0))
+        return re.sub(r'//[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\\n])*"|'
+                      r"'(?:\\.|[^'\\\n])*'|^[ \t]*#(?:[^\n]*\\\n)*[^\n]*",
+                      blank, text, flags=re.S | re.M)
+
+    def ino_prototypes(text):
+        '''
+        Return (line, prototype) for each function defined at the top level
+        of text, line being the 0-based line the definition starts on.
+        Functions already declared, templates and functions with default
+        arguments (which may only be given once) are skipped.
+        '''
+        code = strip_ino(text)
+        found = []
+        declared = set()
+        depth = 0
+        start = 0
+        for i, c in enumerate(code):
+            if c == '{':
+                if depth == 0:
+                    proto = function_head(code[start:i])
+                    if proto is not None:
+                        offset = start + len(code[start:i]) - len(code[start:i].lstrip())
+                        found.append((code.count('\n', 0, offset), proto))
+                depth += 1
+            elif c == '}':
+                depth = max(depth - 1, 0)
+                if depth == 0:
+                    start = i + 1
+            elif c == ';' and depth == 0:
+                proto = function_head(code[start:i])
+                if proto is not None:
+                    declared.add(proto)
+                start = i + 1
+        return [ (line, p) for line, p in found if not (p in declared) ]
+
+    def function_head(head):
+        '''
+        The normalised prototype if head looks like "type name(args)"
+        '''
+        head = ' '.join(head.split())
+        m = re.match(r'^((?:[\w:<>,]+[\s*&]+)+)([A-Za-z_]\w*)\s*\((.*)\)$', head)
+        if m is None or '=' in m.group(3) or '(' in m.group(3):
+            return None
+        if m.group(1).split()[0] in [ 'template', 'return', 'else', 'typedef',
+                                      'using', 'new', 'delete' ]:
+            return None
+        return head
+
+    @env.AddMethod
+    def IncludeScopeReport(env, name='arduino-include-paths'):
+        '''
+        Define an alias which, for the objects built with
+        ARDUINO_SCOPED_INCLUDES, compares the include paths actually used
+        against the paths every compile would have seen with a single
+        global CPPPATH.  Reported are the -I flags per compile, the number
+        of directories the include scanner may search (the #include lines
+        of each source times the number of include directories), and the
+        bytes of -I flags on the command lines.
+        '''
+        def report(target, source, env):
+            print 'Include paths, global CPPPATH -> scoped'
+            print '%-10s %8s %16s %16s %16s' % ('board', 'objects',
+                '-I per compile', 'scanner probes', '-I bytes')
+            scopes = tool_state(env, 'include_scopes')
+            for board in sorted(scopes.keys()):
+                scope = scopes[board]
+                totals = [ 0, 0, 0, 0, 0, 0 ]
+                for obj in unique(scope['objects']):
+                    benv = obj.get_build_env()
+                    dirs = unique([ benv.subst(str(d)) for d in benv.get('CPPPATH', []) ])
+                    every = unique(dirs + sorted(scope['dirs']))
+                    count = count_includes(obj.sources[0])
+                    for i, d in enumerate([ dirs, every ]):
+                        totals[i] += len(d)
+                        totals[2 + i] += count * len(d)
+                        totals[4 + i] += sum([ len(x) + 3 for x in d ])
+                n = max(len(unique(scope['objects'])), 1)
+                print '%-10s %8d %7.1f -> %6.1f %7d -> %6d %7d -> %6d' % (
+                    board, n, totals[1] / float(n), totals[0] / float(n),
+                    totals[3], totals[2], totals[5], totals[4])
+            return 0
+
+        alias = env.Alias(name, [], report)
+        AlwaysBuild(alias)
+        return alias
+
+    def count_includes(source):
+        try:
+            text = source.rfile().get_text_contents()
+        except (IOError, OSError):
+            return 0
+        return len(re.findall(r'^\s*#\s*include', text, re.M))
+
+    @env.AddMethod
+    def CompileExamples(env, libraries, boards, arduino_libraries=None,
+                        options=None, build_dir='#build/examples',
+                        name='arduino-examples'):
+        '''
+        Compile the example sketches of the given libraries for each of the
+        given boards in a single build.  libraries lists the directories of
+        the libraries; every directory under their examples/ directories
+        holding a <dir>.ino is a sketch.  boards lists board names, using
+        the ARDUINO_VERSION and ARDUINO_ARCH environment variables (else
+        env's $VERSION and $ARDUINO_ARCH), or (version, arch, board)
+        tuples.  arduino_libraries names builtin
+        Arduino libraries the examples also link with.
+
+        Each board is configured in a clone of env with its build in
+        build_dir/<board>.  The core and the libraries are built once per
+        board and linked with every example.  Building the alias name
+        (with -k to carry on past failures) then prints whether each
+        example compiled and the size of its firmware, and writes the same
+        to build_dir/<name>.json.
+
+        Given shards=N and shard=K (1 to N) on the command line, the alias
+        holds just the Kth of N shards of the board by example matrix and
+        the results go to build_dir/<name>-K-of-N.json.  The alias
+        <name>-merge merges the shards' results into build_dir/<name>.json.
+        See assign_shards().
+        '''
+        start = time.time()
+        build_dir = env.Dir(build_dir)
+        libraries = [ env.Dir(lib) for lib in env.Flatten([ libraries ]) ]
+        results = []
+        shared = {}
+        for board in env.Flatten([ boards ]):
+            if type(board) is tuple:
+                version, arch, board = board
+            else:
+                version = os.environ.get('ARDUINO_VERSION', env.get('VERSION'))
+                arch = os.environ.get('ARDUINO_ARCH', env.get('ARDUINO_ARCH'))
+                if version is None or arch is None:
+                    raise Exception('CompileExamples: no Arduino version or architecture for ' +
+                                    board + '; set ARDUINO_VERSION and ARDUINO_ARCH or give (version, arch, board)')
+                version = int(version)
+            board_dir = build_dir.Dir(board)
+            board_env = unconfigured_clone(env, VARIANT_DIR = board_dir.path,
+                                           ARDUINO_ARCH = arch,
+                                           ARDUINO_SCOPED_REPOSITORY = True)
+            board_env.ConfigureBoard(version, arch, board, options)
+
+            def declare():
+                libs = [ example_library(board_env, lib) for lib in libraries ]
+                for lib in arduino_libraries or []:
+                    libs.append(board_env.ArduinoLibrary(lib))
+                core = board_env.ArduinoCore()
+                for lib in libraries:
+                    for sketch in example_sketches(lib):
+                        firmware = example_sketch(board_env, lib, sketch,
+                                                  libs + [ core ])
+                        results.append({ 'board'   : board,
+                                         'library' : lib.name,
+                                         'example' : sketch,
+                                         'node'    : firmware[0] })
+                shared[board] = realize_libraries(board_env, libs + [ core ])
+            declare_in(env, board_dir, declare)
+
+        overhead = example_costs(env, results, shared)
+        manifest = { 'shard' : 1, 'shards' : 1, 'start' : start }
+        path = join(build_dir.abspath, name + '.json')
+        shards = int(ARGUMENTS.get('shards', 1))
+        if shards > 1:
+            shard = int(ARGUMENTS.get('shard', 1))
+            if shard < 1 or shard > shards:
+                raise Exception('shard must be between 1 and %d' % shards)
+            assigned, loads = assign_shards(results, overhead, shards)
+            results = [ r for r in results if assigned[example_key(r)] == shard - 1 ]
+            manifest.update(shard = shard, shards = shards,
+                            estimate = round(loads[shard - 1], 4))
+            path = join(build_dir.abspath, '%s-%d-of-%d.json' % (name, shard, shards))
+
+        alias = env.Alias(name, [ r['node'] for r in results ])
+        if len(results) > 0 or shards > 1:
+            # An empty shard still writes its results for the merge
+            atexit.register(examples_report, env, name, results, path, manifest)
+
+        def merge(target, source, env):
+            return merge_manifests(build_dir.abspath, name)
+
+        AlwaysBuild(env.Alias(name + '-merge', [], merge))
+        return alias
+
+    def example_key(result):
+        return '%s:%s/%s' % (result['board'], result['library'], result['example'])
+
+    def example_costs(env, results, shared):
+        '''
+        Estimate the cost of building each example, setting result['cost'],
+        and return the cost of each board's core and libraries.  Targets
+        cost what the durations recorded by CriticalPathScheduling() say
+        they took; targets with no recorded duration cost the mean of those
+        recorded, or 1 when nothing is recorded (i.e., the cost is then
+        the number of targets to build).
+        '''
+        durations = tool_state(env, 'schedule').get('durations')
+        if durations is None:
+            try:
+                with open(env.File('#.arduino-durations.json').abspath) as f:
+                    durations = json.load(f)
+            except (IOError, ValueError):
+                durations = {}
+        default = 1.0
+        if len(durations) > 0:
+            default = sum(durations.values()) / len(durations)
+
+        def cost(nodes, stop):
+            total = 0.0
+            seen = set()
+            pending = list(nodes)
+            while len(pending) > 0:
+                n = pending.pop()
+                if n in seen or n in stop or not n.has_builder():
+                    continue
+                seen.add(n)
+                total += durations.get(str(n), default)
+                pending += n.sources
+            return round(total, 4)
+
+        for r in results:
+            r['cost'] = cost([ r['node'] ], set(shared[r['board']]))
+        return dict([ (board, cost(nodes, set()))
+                      for board, nodes in shared.items() ])
+
+    def assign_shards(results, overhead, shards):
+        '''
+        Partition the examples into shards by longest processing time
+        first: examples are taken in decreasing order of cost and each
+        given to the shard which would then have the least total cost.  A
+        shard pays for a board's core and libraries (overhead[board]) with
+        its first example for that board.  Ties are broken by example name
+        and shard number so that every node computes the same partition
+        from the same durations.
+
+        Returns the shard (0 to shards - 1) of each example by
+        example_key() and the estimated cost of each shard.
+        '''
+        loads = [ 0.0 ] * shards
+        boards = [ set() for i in range(shards) ]
+        assigned = {}
+        for r in sorted(results, key=lambda r: (-r['cost'], example_key(r))):
+            board = r['board']
+
+            def load(k):
+                if board in boards[k]:
+                    return loads[k] + r['cost']
+                return loads[k] + r['cost'] + overhead[board]
+
+            k = min(range(shards), key=lambda k: (load(k), k))
+            loads[k] = load(k)
+            boards[k].add(board)
+            assigned[example_key(r)] = k
+        return assigned, loads
+
+    def unconfigured_clone(env, **kw):
+        '''
+        A clone of env as it was before ConfigureBoard() was first called
+        on it (or on the environment it was cloned from), so that another
+        board can be configured without keeping the first one's $BOARD,
+        $VARIANT, $VARIANT_PATH, include paths and so on, which
+        ConfigureBoard() only sets by default or appends to
+        '''
+        clone = env.Clone(**kw)
+        saved = clone.get('ARDUINO_UNCONFIGURED')
+        if saved is None:
+            return clone
+        for key in BOARD_KEYS:
+            if key in saved:
+                clone[key] = SCons.Util.semi_deepcopy(saved[key])
+            elif key in clone:
+                del clone[key]
+        del clone['ARDUINO_UNCONFIGURED']
+        return clone
+
+    def declare_in(env, path, declare):
+        '''
+        Call declare() with relative file names resolved within the
+        directory path, as they are in a SConscript read with variant_dir
+        '''
+        cwd = env.fs.getcwd()
+        env.fs.chdir(env.Dir(path), change_os_dir=False)
+        try:
+            return declare()
+        finally:
+            env.fs.chdir(cwd, change_os_dir=False)
+
+    def example_library(env, lib):
+        '''
+        Build the library in directory lib (a library outside of the Arduino
+        install) into libraries/<name> of the board's build directory
+        '''
+        root = lib.abspath
+        includes = [ root ]
+        dirs = [ root ]
+        for sub in [ 'src', 'utility' ]:
+            if os.path.isdir(join(root, sub)):
+                includes.append(join(root, sub))
+                dirs.append(join(root, sub))
+        target = join('libraries', lib.name)
+
+        def build(env):
+            objs = []
+            for d in dirs:
+                for s in cfiles(env, d):
+                    objs += env.Object(object_target(env, s, root, target), s)
+            return export_includes(env, env.Library(target, objs), includes)
+
+        return shared_build(add_includes(env, includes), target, build)
+
+    def example_sketches(lib):
+        '''
+        Directories under lib/examples holding a sketch, relative to
+        lib/examples and in name order
+        '''
+        top = join(lib.abspath, 'examples')
+        sketches = []
+        for path, dirs, files in os.walk(top):
+            dirs.sort()
+            if os.path.basename(path) + '.ino' in files:
+                sketches.append(path[len(top) + 1:])
+        return sketches
+
+    def example_sketch(env, lib, sketch, libs):
+        '''
+        Build the example sketch of lib into examples/<lib>/<sketch> of
+        the board's build directory
+        '''
+        path = join(lib.abspath, 'examples', sketch)
+        target = join('examples', lib.name, sketch)
+        sources = []
+        for f in sorted(os.listdir(path)):
+            src = env.File(join(path, f))
+            if f.endswith('.ino'):
+                sources.append(src)
+            elif is_source(src):
+                sources += env.Object(object_target(env, src, path, target), src)
+        return env.Sketch(join(target, os.path.basename(sketch)), sources + libs)
+
+    def examples_report(env, name, results, path, manifest):
+        if not (name in [ str(t) for t in BUILD_TARGETS ]) or GetOption('no_exec'):
+            return
+        failed = set([ f.node for f in GetBuildFailures() ])
+        for r in results:
+            firmware = r.pop('node')
+            r['firmware'] = firmware.path
+            if depends_on(firmware, failed) or not os.path.exists(firmware.abspath):
+                r['status'] = 'fail'
+                r['bytes'] = None
+            else:
+                r['status'] = 'pass'
+                r['bytes'] = firmware_size(firmware.abspath)
+        manifest['elapsed'] = round(time.time() - manifest.pop('start'), 2)
+        manifest['results'] = results
+        print_examples(name, manifest)
+        with open(path, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+    def print_examples(name, manifest):
+        results = manifest['results']
+        passed = len([ r for r in results if r['status'] == 'pass' ])
+        print '%s: %d of %d examples compiled' % (name, passed, len(results))
+        for r in results:
+            if r['status'] == 'pass':
+                size = '%7d bytes' % r['bytes']
+            else:
+                size = 'FAILED'
+            print '  %-16s %-40s %s' % (r['board'],
+                                        r['library'] + '/' + r['example'], size)
+
+    def merge_manifests(build_dir, name):
+        '''
+        Merge the results of the shards in build_dir into <name>.json.  The
+        number of shards is taken from shards=N on the command line, else
+        from the results found.
+        '''
+        pattern = re.compile(re.escape(name) + r'-(\d+)-of-(\d+)\.json$')
+        found = {}
+        for f in os.listdir(build_dir):
+            m = pattern.match(f)
+            if m:
+                found.setdefault(int(m.group(2)), {})[int(m.group(1))] = f
+        if 'shards' in ARGUMENTS:
+            count = int(ARGUMENTS['shards'])
+        elif len(found) == 1:
+            count = found.keys()[0]
+        elif len(found) == 0:
+            return '%s-merge: no shard results in %s' % (name, build_dir)
+        else:
+            return '%s-merge: results for %s shards found; give shards=N' % (
+                name, ' and '.join([ str(n) for n in sorted(found) ]))
+        shards = {}
+        for k, f in found.get(count, {}).items():
+            with open(join(build_dir, f)) as fp:
+                shards[k] = json.load(fp)
+        if len(shards) == 0:
+            return '%s-merge: no results for %d shards in %s' % (name, count, build_dir)
+        missing = [ k for k in range(1, count + 1) if not (k in shards) ]
+
+        results = []
+        for k in sorted(shards):
+            results += shards[k]['results']
+        results.sort(key=lambda r: (r['board'], r['library'], r['example']))
+        elapsed = [ shards[k]['elapsed'] for k in sorted(shards) ]
+        merged = { 'shards'  : count,
+                   'elapsed' : elapsed,
+                   'results' : results }
+        print_examples(name, merged)
+        print '%s: shard times %s, slowest %.1fs, mean %.1fs' % (name,
+            ', '.join([ '%.1fs' % e for e in elapsed ]), max(elapsed),
+            sum(elapsed) / len(elapsed))
+        with open(join(build_dir, name + '.json'), 'w') as f:
+            json.dump(merged, f, indent=1, sort_keys=True)
+        if len(missing) > 0:
+            return '%s-merge: missing results for shards %s' % (name,
+                ', '.join([ str(k) for k in missing ]))
+        keys = [ example_key(r) for r in results ]
+        if len(set(keys)) < len(keys):
+            return '%s-merge: examples built by more than one shard; ' % name + \
+                'were the shards partitioned with different durations?'
+        return 0
+
+    def depends_on(node, nodes):
+        '''
+        True if node or anything built on the way to it is in nodes
+        '''
+        seen = set()
+        pending = [ node ]
+        while len(pending) > 0:
+            n = pending.pop()
+            if n in seen:
+                continue
+            seen.add(n)
+            if n in nodes:
+                return True
+            if n.has_builder():
+                pending += n.sources
+        return False
+
+    def firmware_size(path):
+        '''
+        Bytes of firmware in a .hex (Intel hex data records) or .bin file
+        '''
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(':'):
+            return len(data)
+        size = 0
+        for line in data.splitlines():
+            if line[7:9] == '00':
+                size += int(line[1:3], 16)
+        return size
+
     @env.AddMethod
     def Upload(env, source, name="upload"):
 
@@ -777,3 +2306,1717 @@ def generate(env):
         target = env.Alias(name, source, [tickle, cmd])
         AlwaysBuild(target)
         return target
+
+    @env.AddMethod
+    def ReproducibleBuild(env):
+        '''
+        Make the objects, archives and ELF files built with env independent
+        of when and where they were built.  Call after ConfigureBoard().
+
+          * Sources are archived in name order,
+          * ar and ranlib are run in deterministic mode (no timestamps,
+            uids or gids in the archives),
+          * The source tree and Arduino hardware paths are mapped to
+            fixed names in debug information (and, with gcc 8 or later,
+            in __FILE__ as well), and
+          * g++'s random seed is fixed per object (per batch of objects
+            when compiles are batched; see batch_builder()).
+        '''
+        env['ARDUINO_REPRODUCIBLE'] = True
+
+        arflags = env.subst('$ARFLAGS')
+        if arflags.find('D') < 0:
+            env.Replace(ARFLAGS = arflags + 'D')
+        env.Replace(RANLIBFLAGS = [ '-D' ])
+
+        if gcc_version(env) >= 8:
+            option = '-ffile-prefix-map='
+        else:
+            option = '-fdebug-prefix-map='
+        maps = [ option + env.Dir('#').abspath + '=.',
+                 option + env['BOARD_INFO'].hardware_path + '=arduino' ]
+        env.Replace(PREFIX_MAP = maps)
+        env.Append(CCFLAGS = [ '$PREFIX_MAP', '-frandom-seed=$TARGET' ])
+        if 'ASCOM' in env and env['ASCOM'].find('$PREFIX_MAP') < 0:
+            env['ASCOM'] = env['ASCOM'] + ' $PREFIX_MAP'
+            env['ASPPCOM'] = env['ASCOM']
+
+        return env
+
+    @env.AddMethod
+    def ThinArchives(env):
+        '''
+        Build thin archives, which refer to the objects in place instead of
+        holding copies of them, if $AR can make them.  The archive's symbol
+        index is then written by ar itself (the s flag of the platform's
+        "rcs"), so ranlib is not run again.  Thin archives are never put
+        into, or taken from, a CacheDir() (nor the remote cache), as one
+        retrieved would refer to objects which may not be there.  Call
+        after ConfigureBoard().  Returns True if thin archives are used.
+        '''
+        if not thin_archives_supported(env):
+            print 'Thin archives not supported by ' + env.subst('$AR') + \
+                '; building normal archives'
+            return False
+
+        arflags = env.subst('$ARFLAGS')
+        if arflags.find('T') < 0:
+            env.Replace(ARFLAGS = arflags + 'T')
+        if arflags.find('s') >= 0:
+            env.Replace(RANLIBCOM = '')
+        env.Append(LIBEMITTER = [ thin_archive_emitter ])
+        env['ARDUINO_THIN_ARCHIVES'] = True
+        return True
+
+    def thin_archive_emitter(target, source, env):
+        env.NoCache(target)
+        return target, source
+
+    def thin_archives_supported(env):
+        '''
+        Whether $AR makes a thin archive when asked to; the answer is
+        remembered for the rest of the build
+        '''
+        ar = env.subst('$AR')
+        probes = tool_state(env, 'thin_archives')
+        if ar in probes:
+            return probes[ar]
+
+        tmp = tempfile.mkdtemp()
+        try:
+            with open(join(tmp, 'probe.o'), 'w') as f:
+                f.write('probe\n')
+            with open(os.devnull, 'w') as null:
+                subprocess.call([ ar, 'rcT', 'probe.a', 'probe.o' ], cwd=tmp,
+                                stdout=null, stderr=null)
+            with open(join(tmp, 'probe.a'), 'rb') as f:
+                supported = f.read(8) == '!<thin>\n'
+        except (IOError, OSError):
+            supported = False
+        finally:
+            for name in os.listdir(tmp):
+                os.unlink(join(tmp, name))
+            os.rmdir(tmp)
+
+        probes[ar] = supported
+        return supported
+
+    def gcc_version(env):
+        '''
+        Major version number of $CC, or 0 if it cannot be determined
+        '''
+        try:
+            out = subprocess.Popen([ env.subst('$CC'), '-dumpversion' ],
+                                   stdout=subprocess.PIPE).communicate()[0]
+            return int(out.strip().split('.')[0])
+        except (OSError, ValueError):
+            return 0
+
+    @env.AddMethod
+    def ReproducibilityCheck(env, targets, name='arduino-repro-check'):
+        '''
+        Define an alias which builds targets from clean twice, without
+        using any CacheDir(), and compares every file built byte for byte.
+        The alias fails if any of them differ.  The builds are done by
+        child scons processes, so this scons does not save its own (stale)
+        signatures afterwards; run the check on its own.
+        '''
+        targets = env.arg2nodes(targets, env.fs.File)
+
+        def check(target, source, env):
+            files = tree_files(targets, built=True)
+            names = [ str(t) for t in targets ]
+            args = [ a for a in sys.argv[1:] if a != name ]
+            scons = [ sys.executable, sys.argv[0], '-Q', '--cache-disable' ] + args
+
+            builds = []
+            for i in range(2):
+                for cmd in [ [ '-c' ], [] ]:
+                    status = subprocess.call(scons + cmd + names,
+                                             cwd=env.Dir('#').abspath)
+                    skip_sconsign_write()
+                    if status != 0:
+                        return 'build failed'
+                digests = {}
+                for f in files:
+                    if os.path.exists(f):
+                        with open(f, 'rb') as fd:
+                            digests[f] = hashlib.md5(fd.read()).hexdigest()
+                builds.append(digests)
+
+            differ = [ f for f in files
+                       if builds[0].get(f) != builds[1].get(f) ]
+            for f in differ:
+                print 'differs: ' + f
+            print '%d of %d built files are reproducible' % (
+                len(files) - len(differ), len(files))
+            return len(differ) != 0
+
+        alias = env.Alias(name, [], check)
+        AlwaysBuild(alias)
+        return alias
+
+    @env.AddMethod
+    def ArduinoCacheDir(env, path, budget=None):
+        '''
+        Use CacheDir(path) for env and keep statistics on how well the
+        cache does for the objects, archives, ELF and hex files built by
+        this tool.  Hits, misses and bytes are kept per board and artifact
+        type in arduino-stats.json within the cache and the results of
+        each build are printed when scons exits.
+
+        When budget is given (bytes, or a string such as '500M' or '2G'),
+        the least recently used files are removed from the cache at exit
+        until it fits within the budget.  Cache hits count as uses.
+
+        Two aliases are also defined: arduino-cache-stats prints the
+        accumulated statistics and arduino-cache-prune prunes the cache
+        to the budget.
+        '''
+        path = env.Dir(path).abspath
+        env.CacheDir(path)
+        budget = parse_size(budget)
+
+        caches = tool_state(env, 'caches')
+        if len(caches) == 0:
+            atexit.register(cache_report, env)
+        caches[path] = budget
+
+        def stats(target, source, env):
+            print_cache_stats(load_cache_stats(path))
+            return 0
+
+        def prune(target, source, env):
+            if budget is None:
+                return 'arduino-cache-prune: no budget was given'
+            prune_cache(path, budget)
+            return 0
+
+        aliases = [ env.Alias('arduino-cache-stats', [], stats),
+                    env.Alias('arduino-cache-prune', [], prune) ]
+        AlwaysBuild(aliases)
+        return env
+
+    def parse_size(size):
+        if size is None or type(size) in [ int, long ]:
+            return size
+        size = size.strip().upper()
+        scale = { 'K' : 1 << 10, 'M' : 1 << 20, 'G' : 1 << 30 }
+        if size[-1] in scale:
+            return int(float(size[:-1]) * scale[size[-1]])
+        return int(size)
+
+    def cache_report(env):
+        '''
+        At exit, tally what this build got from, and put into, the cache(s)
+        and prune them.  Nothing is done for scons -n or -c.
+        '''
+        if GetOption('no_exec') or GetOption('clean'):
+            return
+        runs = {}
+        for node, board in board_artifacts(env).items():
+            cache = node.get_build_env().get_CacheDir()
+            if not cache.is_enabled() or not (cache.path in tool_state(env, 'caches')):
+                continue
+            if getattr(node, 'cached', 0):
+                # scons touched the cache entry, a use for the LRU pruning
+                outcome = 'hit'
+            elif node.get_state() == SCons.Node.executed:
+                outcome = 'miss'
+            else:
+                continue
+            try:
+                size = os.path.getsize(node.abspath)
+            except OSError:
+                size = 0
+            run = runs.setdefault(cache.path, {})
+            entry = run.setdefault(board, {}).setdefault(artifact_kind(node),
+                                                         new_cache_entry())
+            entry[{ 'hit' : 'hits', 'miss' : 'misses' }[outcome]] += 1
+            entry[outcome + '_bytes'] += size
+
+        for path, budget in tool_state(env, 'caches').items():
+            if path in runs:
+                print 'Arduino cache %s, this build:' % path
+                print_cache_stats(runs[path])
+                totals = load_cache_stats(path)
+                for board, kinds in runs[path].items():
+                    for kind, entry in kinds.items():
+                        total = totals.setdefault(board, {}).setdefault(
+                            kind, new_cache_entry())
+                        for key in entry:
+                            total[key] += entry[key]
+                with open(join(path, 'arduino-stats.json'), 'w') as f:
+                    json.dump(totals, f, indent=1, sort_keys=True)
+            if not (budget is None):
+                prune_cache(path, budget)
+
+    def new_cache_entry():
+        return { 'hits' : 0, 'misses' : 0, 'hit_bytes' : 0, 'miss_bytes' : 0 }
+
+    def load_cache_stats(path):
+        try:
+            with open(join(path, 'arduino-stats.json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def print_cache_stats(stats):
+        print '  %-12s %-8s %8s %8s %6s %12s' % ('board', 'type', 'hits',
+            'misses', 'hit %', 'bytes hit')
+        for board in sorted(stats.keys()):
+            for kind in sorted(stats[board].keys()):
+                e = stats[board][kind]
+                tries = e['hits'] + e['misses']
+                print '  %-12s %-8s %8d %8d %5.1f%% %12d' % (board, kind,
+                    e['hits'], e['misses'], 100.0 * e['hits'] / max(tries, 1),
+                    e['hit_bytes'])
+
+    def prune_cache(path, budget):
+        '''
+        Remove the least recently used files from the cache until what
+        remains fits within budget bytes
+        '''
+        files = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in filenames:
+                if dirpath == path:
+                    # scons' config file and our statistics
+                    continue
+                f = join(dirpath, name)
+                try:
+                    st = os.stat(f)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, f))
+                total += st.st_size
+
+        removed = 0
+        freed = 0
+        for mtime, size, f in sorted(files):
+            if total <= budget:
+                break
+            try:
+                os.unlink(f)
+            except OSError:
+                continue
+            total -= size
+            freed += size
+            removed += 1
+        if removed:
+            print 'Arduino cache %s: pruned %d files (%d bytes); %d bytes remain' % (
+                path, removed, freed, total)
+
+    @env.AddMethod
+    def ArduinoGC(env, budget=None, stale_days=None, links=False,
+                  name='arduino-gc'):
+        '''
+        Define an alias which cleans up the board build directories (the
+        VARIANT_DIR of each board configured).  In parallel over the board
+        directories, it removes objects, archives, ELF, hex and map files
+        which are no longer targets of this build.  Board directories
+        under the same parent which this build does not configure are
+        removed when last configured over stale_days days ago, and then,
+        oldest first, while all of them together exceed budget bytes
+        (e.g., '2G').  Board directories are recognised by the file
+        .arduino-board, which is touched each time the board is configured
+        once this has been called.  With links=True, the links to the
+        architecture directory which ConfigureBoard() left in the Arduino
+        hardware tree for those other board directories are removed too;
+        as the hardware tree may be shared with other projects, this is
+        off by default.
+        '''
+        tool_state(env, 'gc')['enabled'] = True
+        for path in tool_state(env, 'board_dirs'):
+            mark_board_dir(path)
+
+        def gc(target, source, env):
+            boards = tool_state(env, 'board_dirs')
+            current = sorted(boards.keys())
+            swept = {}
+
+            def sweep(path):
+                swept[path] = sweep_board_dir(env, path)
+
+            run_parallel(sweep, current)
+            removed = sum([ r[0] for r in swept.values() ])
+            freed = sum([ r[1] for r in swept.values() ])
+            print 'Arduino GC: removed %d orphaned files (%d bytes) from %d board directories' % (
+                removed, freed, len(current))
+
+            others = []
+            for root in unique([ os.path.dirname(p) for p in current ]):
+                for entry in sorted(os.listdir(root)):
+                    path = join(root, entry)
+                    if not (path in boards) and \
+                       os.path.isfile(join(path, BOARD_MARKER)):
+                        others.append((os.path.getmtime(join(path, BOARD_MARKER)), path))
+            others.sort()
+            stale = [ p for m, p in others ]
+
+            if stale_days is not None:
+                limit = time.time() - stale_days * 86400
+                for mtime, path in [ o for o in others if o[0] < limit ]:
+                    print 'Arduino GC: removing %s, last configured %s' % (
+                        path, time.ctime(mtime))
+                    remove_tree(path)
+                others = [ o for o in others if o[0] >= limit ]
+
+            limit = parse_size(budget)
+            if limit is not None:
+                sizes = {}
+
+                def measure(path):
+                    sizes[path] = tree_size(path)
+
+                run_parallel(measure, current + [ p for m, p in others ])
+                total = sum(sizes.values())
+                for mtime, path in others:
+                    if total <= limit:
+                        break
+                    print 'Arduino GC: removing %s (%d bytes), last configured %s' % (
+                        path, sizes[path], time.ctime(mtime))
+                    remove_tree(path)
+                    total -= sizes[path]
+                if total > limit:
+                    print 'Arduino GC: %d bytes in board directories built now, over the budget of %d' % (
+                        total, limit)
+
+            if links:
+                count = remove_board_links(boards, stale)
+                if count:
+                    print 'Arduino GC: removed %d links from the Arduino hardware tree' % count
+            return 0
+
+        alias = env.Alias(name, [], gc)
+        AlwaysBuild(alias)
+        return alias
+
+    def mark_board_dir(path):
+        if GetOption('no_exec'):
+            return
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(join(path, BOARD_MARKER), 'w') as f:
+            f.write('Board build directory, see ArduinoGC()\n')
+
+    def sweep_board_dir(env, path):
+        '''
+        Remove the build outputs under path which are not targets of this
+        build, then any directories left empty.  Returns the number of
+        files removed and their size.
+        '''
+        known = set()
+        dirs = [ env.Dir(path) ]
+        while dirs:
+            d = dirs.pop()
+            for name, node in d.entries.items():
+                if name in [ '.', '..' ]:
+                    continue
+                if isinstance(node, SCons.Node.FS.Dir):
+                    dirs.append(node)
+                elif node.has_builder() or node.is_derived():
+                    known.add(node.abspath)
+
+        removed = 0
+        freed = 0
+        for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+            for name in filenames:
+                f = join(dirpath, name)
+                stem, suffix = os.path.splitext(f)
+                if not (suffix in GC_SUFFIXES) or f in known:
+                    continue
+                if suffix == '.d' and (stem + '.o') in known:
+                    continue
+                try:
+                    size = os.path.getsize(f)
+                    os.unlink(f)
+                except OSError:
+                    continue
+                removed += 1
+                freed += size
+            if dirpath != path and len(os.listdir(dirpath)) == 0:
+                os.rmdir(dirpath)
+        return removed, freed
+
+    def tree_size(path):
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in filenames:
+                try:
+                    total += os.lstat(join(dirpath, name)).st_size
+                except OSError:
+                    pass
+        return total
+
+    def remove_tree(path):
+        for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+            for name in filenames:
+                os.unlink(join(dirpath, name))
+            for name in dirnames:
+                if os.path.islink(join(dirpath, name)):
+                    os.unlink(join(dirpath, name))
+                else:
+                    os.rmdir(join(dirpath, name))
+        os.rmdir(path)
+
+    def remove_board_links(boards, stale):
+        '''
+        Remove the links ConfigureBoard() made in the Arduino hardware tree
+        for the board directories in stale.  Only a link named after one
+        of them which points at the architecture directory of a configured
+        board, and which no configured board uses, is removed.  Returns
+        the number of links removed.
+        '''
+        keep = set()
+        for info, links in boards.values():
+            keep.update(links)
+
+        removed = 0
+        for info, links in boards.values():
+            target = os.path.realpath(info.arch_path)
+            for path in stale:
+                link = join(info.arduino_path, os.path.basename(path))
+                if os.path.islink(link) and not (link in keep) and \
+                   os.path.realpath(link) == target:
+                    os.unlink(link)
+                    keep.add(link)
+                    removed += 1
+        return removed
+
+    @env.AddMethod
+    def UseRemoteCache(env, url, workers=4):
+        '''
+        Back env's CacheDir() (see ArduinoCacheDir()) with the HTTP build
+        cache at url.  A file missing from the local cache is fetched from
+        the remote cache, and everything put into the local cache is also
+        sent to the remote cache.  Call this before building the core and
+        libraries so that the environments cloned for them use it too.
+        '''
+        remotes = tool_state(env, 'remote_caches')
+        if not (url in remotes):
+            remotes[url] = RemoteCache(url, workers)
+            atexit.register(remotes[url].close)
+        remote = remotes[url]
+
+        def get_CacheDir(env):
+            try:
+                path = env._CacheDir_path
+            except AttributeError:
+                path = SCons.Defaults.DefaultEnvironment()._CacheDir_path
+            key = (path, url)
+            caches = tool_state(env, 'remote_cache_dirs')
+            if not (key in caches):
+                caches[key] = RemoteCacheDir(path, remote)
+            return caches[key]
+
+        env.AddMethod(get_CacheDir)
+        return env
+
+    @env.AddMethod
+    def ArduinoCacheServer(env, root, host='127.0.0.1', port=8642,
+                           name='arduino-cache-server'):
+        '''
+        Define an alias which runs an HTTP build cache server, storing
+        its entries in root, until interrupted.  Point UseRemoteCache()
+        at http://host:port/.
+        '''
+        root = env.Dir(root).abspath
+
+        def serve(target, source, env):
+            server = CacheServer(root, host, port, quiet=False)
+            print 'Serving build cache %s on http://%s:%d/' % (root, host, port)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            return 0
+
+        alias = env.Alias(name, [], serve)
+        AlwaysBuild(alias)
+        return alias
+
+    @env.AddMethod
+    def CriticalPathScheduling(env, path='#.arduino-durations.json'):
+        '''
+        Record how long each target takes to build and, on later builds,
+        start the targets at the head of the longest predicted chains
+        first.  A node's priority is its recorded build time plus the
+        largest priority among its children, so a big compile feeding an
+        archive feeding the Elf link is started ahead of small compiles.
+        Targets never built before get no priority.
+
+        The durations are kept in path.  At exit, the predicted and the
+        actual wall clock time of the build are printed.
+        '''
+        sched = tool_state(env, 'schedule')
+        if 'path' in sched:
+            return env
+
+        sched['path'] = env.File(path).abspath
+        sched['jobs'] = GetOption('num_jobs')
+        sched['run'] = {}
+        try:
+            with open(sched['path']) as f:
+                sched['durations'] = json.load(f)
+        except (IOError, ValueError):
+            sched['durations'] = {}
+
+        durations = sched['durations']
+        priorities = {}
+
+        def priority(node):
+            if node in priorities:
+                return priorities[node]
+            p = 0.0
+            if node.has_builder():
+                for child in node.children(scan=0):
+                    p = max(p, priority(child))
+                p += durations.get(str(node), 0.0)
+            priorities[node] = p
+            return p
+
+        # The Taskmaster pushes a node's children onto its candidate stack
+        # and pops them off the end; put the most important last.
+        Taskmaster = SCons.Taskmaster.Taskmaster
+        taskmaster_init = Taskmaster.__init__
+
+        def init(self, *args, **kw):
+            taskmaster_init(self, *args, **kw)
+            order = self.order
+            self.order = lambda nodes: sorted(order(nodes), key=priority)
+            sched['start'] = time.time()
+
+        Taskmaster.__init__ = init
+
+        task_execute = SCons.Taskmaster.Task.execute
+
+        def execute(self):
+            start = time.time()
+            task_execute(self)
+            if not getattr(self.targets[0], 'cached', 0):
+                elapsed = time.time() - start
+                for t in self.targets:
+                    if isinstance(t, SCons.Node.FS.File):
+                        sched['run'][t] = elapsed
+
+        SCons.Taskmaster.Task.execute = execute
+
+        atexit.register(schedule_report, sched)
+        return env
+
+    def schedule_report(sched):
+        run = sched['run']
+        if len(run) == 0 or not ('start' in sched):
+            return
+        actual = time.time() - sched['start']
+
+        # Predicted critical path and total work of what was built
+        durations = sched['durations']
+        chain = {}
+
+        def longest(node):
+            if not (node in chain):
+                chain[node] = durations.get(str(node), 0.0) + max(
+                    [ 0.0 ] + [ longest(c) for c in node.children(scan=0)
+                                if c in run ])
+            return chain[node]
+
+        work = sum([ durations.get(str(t), 0.0) for t in set(run) ])
+        path = max([ longest(t) for t in run ])
+        known = len([ t for t in run if str(t) in durations ])
+        predicted = max(path, work / max(sched['jobs'], 1))
+
+        for t, elapsed in run.items():
+            durations[str(t)] = round(elapsed, 4)
+        try:
+            with open(sched['path'], 'w') as f:
+                json.dump(durations, f, indent=0, sort_keys=True)
+        except IOError:
+            pass
+
+        print 'Build time: %.2fs actual, %.2fs predicted (critical path %.2fs, %d of %d targets known, -j %d)' % (
+            actual, predicted, path, known, len(run), sched['jobs'])
+
+    @env.AddMethod
+    def IncludeCostReport(env, name='arduino-include-cost', top=25):
+        '''
+        Define an alias which compiles (with -fsyntax-only -H) every C and
+        C++ translation unit of the core, libraries and sketches built by
+        this tool and counts how many times each header is included.  The
+        top most included headers are then each compiled on their own to
+        time them.  A table ranked by estimated total cost (inclusions
+        times the time to compile the header alone) is printed and written
+        to arduino-include-cost.json at the top of the project.
+        '''
+        def report(target, source, env):
+            units = []
+            for node in sorted(board_artifacts(env).keys(), key=str):
+                if artifact_kind(node) != 'object' or len(node.sources) == 0:
+                    continue
+                src = node.sources[0]
+                if os.path.splitext(str(src))[1] in [ '.c', '.cpp', '.cc', '.cxx' ]:
+                    units.append((node, src))
+
+            counts = {}
+            where = {}
+            tu_time = [ 0.0 ]
+            lock = threading.Lock()
+
+            def scan(unit):
+                obj, src = unit
+                cmd = syntax_only_command(obj, src) + [ '-H', src.rfile().abspath ]
+                start = time.time()
+                proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        cwd=env.Dir('#').abspath)
+                err = proc.communicate()[1]
+                elapsed = time.time() - start
+                with lock:
+                    tu_time[0] += elapsed
+                    for line in err.splitlines():
+                        m = re.match(r'^(\.+) (.*)$', line)
+                        if m is None:
+                            if line.startswith('Multiple include guards'):
+                                break
+                            continue
+                        header = os.path.normpath(m.group(2))
+                        counts[header] = counts.get(header, 0) + 1
+                        where.setdefault(header, unit)
+
+            run_parallel(scan, units)
+
+            ranked = sorted(counts.keys(), key=lambda h: -counts[h])[:top]
+            alone = {}
+
+            def time_header(header):
+                obj, src = where[header]
+                suffix = os.path.splitext(str(src))[1]
+                # gcc -H prints paths as given on the command line, which
+                # may be relative to the top of the project; the stub is
+                # compiled from elsewhere
+                path = os.path.normpath(join(env.Dir('#').abspath, header))
+                fd, stub = tempfile.mkstemp(suffix=suffix)
+                os.write(fd, '#include "%s"\n' % path)
+                os.close(fd)
+                try:
+                    start = time.time()
+                    with open(os.devnull, 'w') as null:
+                        status = subprocess.call(
+                            syntax_only_command(obj, src) + [ stub ],
+                            stdout=null, stderr=null, cwd=env.Dir('#').abspath)
+                    # A header which does not compile on its own (e.g., one
+                    # relying on what its includer declared first) has no
+                    # meaningful time
+                    alone[header] = time.time() - start if status == 0 else None
+                finally:
+                    os.unlink(stub)
+
+            run_parallel(time_header, ranked)
+
+            failed = [ h for h in ranked if alone[h] is None ]
+            rows = sorted([ (counts[h] * alone[h], counts[h], alone[h], h)
+                            for h in ranked if not (h in failed) ], reverse=True)
+            print '%d translation units, %.2fs compiling with -fsyntax-only' % (
+                len(units), tu_time[0])
+            print '%10s %8s %10s  %s' % ('est. cost', 'includes', 'alone', 'header')
+            for cost, count, single, header in rows:
+                print '%9.2fs %8d %9.3fs  %s' % (cost, count, single, header)
+            for header in failed:
+                print '%10s %8d %10s  %s' % ('-', counts[header], 'failed', header)
+
+            with open(env.File('#arduino-include-cost.json').abspath, 'w') as f:
+                json.dump([ { 'header' : h, 'includes' : c, 'seconds_alone' : t,
+                              'estimated_seconds' : e }
+                            for e, c, t, h in rows ] +
+                          [ { 'header' : h, 'includes' : counts[h],
+                              'failed' : True } for h in failed ], f, indent=1)
+            return 0
+
+        alias = env.Alias(name, [], report)
+        AlwaysBuild(alias)
+        return alias
+
+    def syntax_only_command(obj, src):
+        '''
+        Compiler command line to check src as it is compiled for obj, but
+        without producing any output, and without the source file itself
+        '''
+        benv = obj.get_build_env()
+        if os.path.splitext(str(src))[1] == '.c':
+            com = '$CC -fsyntax-only $CFLAGS $CCFLAGS $_CCCOMCOM'
+        else:
+            com = '$CXX -fsyntax-only $CXXFLAGS $CCFLAGS $_CCCOMCOM'
+        cmd = benv.subst_list(com, target=[ obj ], source=[ src ])[0]
+        # Drop anything producing output files
+        return [ str(a) for a in cmd
+                 if not (str(a) in [ '-MMD', '-MD', '-c', '-save-temps' ]) ]
+
+    def run_parallel(func, items):
+        '''
+        Call func for each of items using as many threads as scons jobs
+        '''
+        work = Queue.Queue()
+        for item in items:
+            work.put(item)
+
+        def worker():
+            while True:
+                try:
+                    item = work.get_nowait()
+                except Queue.Empty:
+                    return
+                func(item)
+
+        threads = [ threading.Thread(target=worker)
+                    for i in range(max(GetOption('num_jobs'), 1)) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    @env.AddMethod
+    def DependencyQuery(env, name='arduino-deps', path='#.arduino-deps.json'):
+        '''
+        Define an alias answering questions about the dependency graph of
+        everything this tool builds, for all boards configured:
+
+          scons arduino-deps rdeps=X          what is rebuilt if X changes
+          scons arduino-deps rdeps=X why=Y    the chain of dependencies
+                                              making Y depend on X
+
+        X and Y may be paths or just the ends of paths (e.g.,
+        rdeps=Arduino.h).  The answers come from an index of the
+        dependencies scons recorded in .sconsign on the last build,
+        including the scanned headers, so no sources are scanned.  The
+        index is saved in path and rebuilt only when .sconsign or the set
+        of targets changes.
+        '''
+        def query(target, source, env):
+            index = dependency_index(env, env.File(path).abspath)
+            rdeps = ARGUMENTS.get('rdeps')
+            why = ARGUMENTS.get('why')
+            if rdeps is None:
+                print 'Dependency index of %d targets; query with rdeps=X [why=Y]' % (
+                    len(index['targets']))
+                return 0
+
+            found = match_paths(index, rdeps)
+            if len(found) == 0:
+                print 'Nothing built depends on ' + rdeps
+                return 0
+
+            if why is None:
+                print_rdeps(index, found)
+            else:
+                for y in match_paths(index, why):
+                    chain = dependency_chain(index, y, set(found))
+                    if chain is None:
+                        print '%s does not depend on %s' % (y, rdeps)
+                    else:
+                        print '\n  -> '.join(chain)
+            return 0
+
+        alias = env.Alias(name, [], query)
+        AlwaysBuild(alias)
+        return alias
+
+    def dependency_index(env, path):
+        '''
+        Map each target built by the tool to its board, kind and direct
+        dependencies (sources, explicit and scanned dependencies) as
+        recorded in .sconsign.  Paths are absolute.
+        '''
+        artifacts = board_artifacts(env)
+        targets = {}
+        todo = list(artifacts.keys())
+        while todo:
+            entry = todo.pop()
+            node = entry.disambiguate()
+            if node in targets:
+                continue
+            targets[node] = artifacts.get(entry)
+            for child in node.sources + node.depends:
+                if child.has_builder() and not (child in targets):
+                    artifacts.setdefault(child, targets[node])
+                    todo.append(child)
+
+        names = sorted([ t.abspath for t in targets ])
+        stamp = [ sconsign_mtime(env), hashlib.md5('\n'.join(names)).hexdigest() ]
+        try:
+            with open(path) as f:
+                index = json.load(f)
+            if index['stamp'] == stamp:
+                return index
+        except (IOError, ValueError, KeyError):
+            pass
+
+        top = env.Dir('#').abspath
+        index = { 'stamp' : stamp, 'targets' : {} }
+        for node, board in targets.items():
+            binfo = getattr(node.get_stored_info(), 'binfo', None)
+            deps = [ os.path.normpath(join(top, str(d))) for d in
+                     getattr(binfo, 'bsources', []) + getattr(binfo, 'bdepends', []) +
+                     getattr(binfo, 'bimplicit', []) ]
+            if len(deps) == 0:
+                # Never built: only the sources are known
+                deps = [ s.abspath for s in node.sources + node.depends ]
+            index['targets'][node.abspath] = { 'board' : board,
+                'kind' : artifact_kind(node), 'deps' : sorted(set(deps)) }
+        try:
+            with open(path, 'w') as f:
+                json.dump(index, f)
+        except IOError:
+            pass
+        return index
+
+    def sconsign_mtime(env):
+        for name in [ SCons.SConsign.DB_Name + '.dblite', SCons.SConsign.DB_Name ]:
+            try:
+                return os.path.getmtime(env.File('#' + name).abspath)
+            except OSError:
+                pass
+        return None
+
+    def reverse_dependencies(index):
+        rev = {}
+        for t, entry in index['targets'].items():
+            for d in entry['deps']:
+                rev.setdefault(d, []).append(t)
+        return rev
+
+    def match_paths(index, name):
+        '''
+        The files in the index named name: the same absolute path, or a
+        path ending with name
+        '''
+        every = set(index['targets'].keys())
+        for entry in index['targets'].values():
+            every.update(entry['deps'])
+        full = os.path.abspath(name)
+        if full in every:
+            return [ full ]
+        tail = os.sep + os.path.normpath(name).lstrip(os.sep)
+        return sorted([ p for p in every if p.endswith(tail) ])
+
+    def print_rdeps(index, found):
+        '''
+        Print, per board and kind, what depends on the files found
+        '''
+        rev = reverse_dependencies(index)
+        seen = set()
+        todo = list(found)
+        while todo:
+            f = todo.pop()
+            for t in rev.get(f, []):
+                if not (t in seen):
+                    seen.add(t)
+                    todo.append(t)
+
+        print 'Depending on %s:' % ', '.join(found)
+        boards = {}
+        for t in seen:
+            entry = index['targets'][t]
+            boards.setdefault(entry['board'] or '-', []).append((entry['kind'], t))
+        kinds = [ 'object', 'archive', 'elf', 'hex', 'other' ]
+        for board in sorted(boards.keys()):
+            counts = [ len([ k for k, t in boards[board] if k == kind ]) for kind in kinds ]
+            print '  %-10s %s' % (board, ', '.join([ '%d %s' % (n, kind)
+                for n, kind in zip(counts, kinds) if n ]))
+            for kind, t in sorted(boards[board], key=lambda e: (kinds.index(e[0]), e[1])):
+                print '      ' + t
+        print '%d targets on %d boards' % (len(seen), len(boards))
+
+    def dependency_chain(index, start, goals):
+        '''
+        Shortest chain of dependencies from start to one of goals, or None.
+        The chain runs from start to the goal.
+        '''
+        previous = { start : None }
+        todo = [ start ]
+        while todo:
+            later = []
+            for node in todo:
+                if node in goals:
+                    chain = []
+                    while node is not None:
+                        chain.insert(0, node)
+                        node = previous[node]
+                    return chain
+                for d in index['targets'].get(node, {}).get('deps', []):
+                    if not (d in previous):
+                        previous[d] = node
+                        later.append(d)
+            todo = later
+        return None
+
+    @env.AddMethod
+    def UseResponseFiles(env, length=4096, compile=False):
+        '''
+        Pass the arguments of link (Elf) and archive commands longer than
+        length characters to the tool in an @response file.  When compile
+        is True, compile commands are treated the same way.  Call this
+        after ConfigureBoard().  With DistributedCompile(), $DISTCC and the
+        compiler stay on the command line and only the compiler's
+        arguments go in the response file; distcc cannot look inside a
+        response file, so it runs such compiles locally.
+
+        This uses scons' TEMPFILE facility.  The build signatures are
+        computed from the commands themselves and not the response files,
+        so targets are not rebuilt merely because a response file was
+        (re)created.
+        '''
+        env['MAXLINELENGTH'] = length
+
+        coms = [ 'ELFCOM', 'ARCOM' ]
+        if compile:
+            coms += [ 'CCCOM', 'CXXCOM', 'ASCOM', 'ASPPCOM',
+                      'ARDUINO_BATCHCCCOM', 'ARDUINO_BATCHCXXCOM' ]
+
+        for com in coms:
+            if com in env and env[com].find('TEMPFILE') < 0:
+                # The response file takes all but the first word, which
+                # must be the compiler rather than distcc
+                prefix = ''
+                if env[com].startswith('$DISTCC '):
+                    prefix = '$DISTCC '
+                env['_' + com] = env[com][len(prefix):]
+                env[com] = prefix + '${TEMPFILE("$_%s")}' % com
+
+        return env
+
+    @env.AddMethod
+    def DistributedCompile(env, hosts=None, local_workers=0, jobs=4,
+                           base_port=3632):
+        '''
+        Dispatch the C, C++ and assembler compiles through distcc.  Call
+        this after ConfigureBoard() as the ASCOM recipe is set there.
+
+        distcc preprocesses locally and ships the preprocessed source to
+        the hosts listed in hosts (a list or a DISTCC_HOSTS style string).
+        When local_workers is non-zero, that many distccd daemons are
+        started on 127.0.0.1 at ports base_port, base_port+1, ... and
+        added to the host list.  This allows the remote compile path to
+        be exercised on a single machine.  The daemons are stopped when
+        scons exits, and are not started at all for scons -c or -n.
+        '''
+
+        if hosts is None:
+            hosts = os.environ.get('DISTCC_HOSTS', '').split()
+        elif type(hosts) is str:
+            hosts = hosts.split()
+        else:
+            hosts = list(hosts)
+
+        # A child scons (see ArduinoWatch() and ReproducibilityCheck())
+        # uses the daemons its parent started
+        compiling = not (GetOption('clean') or GetOption('no_exec'))
+        running = os.environ.get('ARDUINO_DISTCCD_PORTS', '').split()
+        for i in range(local_workers):
+            port = base_port + i
+            if compiling and not (str(port) in running):
+                start_distccd(env, port, jobs)
+                running.append(str(port))
+            # Note: distcc treats 'localhost' as "compile locally"
+            hosts.append('127.0.0.1:%d/%d' % (port, jobs))
+
+        if len(hosts) == 0:
+            raise Exception('DistributedCompile: no distcc hosts given')
+        if running:
+            os.environ['ARDUINO_DISTCCD_PORTS'] = ' '.join(running)
+
+        env.SetDefault(DISTCC = env.WhereIs('distcc') or 'distcc')
+        env['ENV']['DISTCC_HOSTS'] = ' '.join(hosts)
+
+        for com in [ 'CCCOM', 'CXXCOM', 'ASCOM', 'ASPPCOM',
+                     'ARDUINO_BATCHCCCOM', 'ARDUINO_BATCHCXXCOM' ]:
+            if com in env and not env[com].startswith('$DISTCC '):
+                env[com] = '$DISTCC ' + env[com]
+
+        # Without -j, there's no point to any of this
+        if GetOption('num_jobs') == 1:
+            slots = 0
+            for host in hosts:
+                if '/' in host:
+                    slots += int(host.split('/')[1].split(',')[0])
+                else:
+                    slots += 2
+            SetOption('num_jobs', slots)
+
+        return env
+
+    def start_distccd(env, port, jobs):
+        '''
+        Start a distccd daemon listening on 127.0.0.1:port
+        '''
+        distccd = env.WhereIs('distccd')
+        if distccd is None:
+            raise Exception('DistributedCompile: distccd not found in PATH')
+
+        cmd = [ distccd, '--daemon', '--no-detach', '--log-stderr',
+                '--allow', '127.0.0.1', '--listen', '127.0.0.1',
+                '--port', str(port), '--jobs', str(jobs) ]
+
+        # distcc 3.3 and later only run whitelisted compilers unless told
+        # otherwise; the Arduino toolchain is never on that whitelist
+        usage = subprocess.Popen([ distccd, '--help' ], stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT).communicate()[0]
+        if usage.find('--enable-tcp-insecure') >= 0:
+            cmd.append('--enable-tcp-insecure')
+
+        with open(os.devnull, 'w') as null:
+            proc = subprocess.Popen(cmd, stdout=null, stderr=null)
+        atexit.register(stop_process, proc)
+
+        # distcc quietly compiles locally when it cannot connect, so do not
+        # hand out the port until the daemon is listening on it
+        deadline = time.time() + 10.0
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), 0.5).close()
+                return
+            except socket.error:
+                pass
+            if proc.poll() is not None:
+                raise Exception('DistributedCompile: distccd on port %d exited (status %d)' %
+                                (port, proc.returncode))
+            if time.time() > deadline:
+                raise Exception('DistributedCompile: distccd is not listening on port %d' % port)
+            time.sleep(0.05)
+
+    def stop_process(proc):
+        if proc.poll() is None:
+            proc.terminate()
+            proc.wait()
+
+    def skip_sconsign_write():
+        '''
+        Keep this scons from saving .sconsign.dblite when the build ends.
+        After a child scons has built in the same tree, this scons's copy
+        of the signatures is stale and saving it would undo the child's.
+        Everything else done at exit still runs.
+        '''
+        SCons.SConsign.write = lambda: None
+
+    @env.AddMethod
+    def ArduinoWatch(env, targets, name='arduino-watch', interval=0.25):
+        '''
+        Define an alias, by default "arduino-watch", which watches the
+        sources and headers that targets depend upon and rebuilds targets
+        whenever one of them changes,
+
+            scons arduino-watch
+
+        The rebuilds are done by a resident "scons --interactive" so
+        that the SConstruct files, ConfigureBoard() and the dependency
+        scan are only processed once.  Newly added source files are not
+        seen until the watch is restarted.  Since the resident scons keeps
+        the signatures up to date, this scons does not save its own when
+        the watch stops, so run the watch on its own.
+        '''
+
+        targets = env.arg2nodes(targets, env.fs.File)
+
+        def watch(target, source, env):
+            files = tree_files(targets)
+            board = env.subst('$BOARD')
+            names = [ str(t) for t in targets ]
+
+            args = [ a for a in sys.argv[1:] if a != name ]
+            child = subprocess.Popen([ sys.executable, sys.argv[0],
+                                       '--interactive', '-Q' ] + args,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     cwd=env.Dir('#').abspath)
+            try:
+                read_until_prompt(child)
+                print 'Watching %d files for %s; ^C to stop' % (len(files), board)
+                mtimes = file_mtimes(files)
+                while child.poll() is None:
+                    time.sleep(interval)
+                    current = file_mtimes(files)
+                    changed = [ f for f in files if current[f] != mtimes[f] ]
+                    if len(changed) == 0:
+                        continue
+                    # Let editors finish writing before building
+                    time.sleep(interval)
+                    mtimes = file_mtimes(files)
+                    saved = max([ mtimes[f] for f in changed ])
+                    child.stdin.write('build %s\n' % ' '.join(names))
+                    child.stdin.flush()
+                    read_until_prompt(child)
+                    print '%s: %s rebuilt %.2fs after save of %s' % (
+                        board, ', '.join(names), time.time() - saved,
+                        os.path.basename(changed[0]))
+            except KeyboardInterrupt:
+                pass
+            finally:
+                stop_process(child)
+                skip_sconsign_write()
+            return 0
+
+        alias = env.Alias(name, [], watch)
+        AlwaysBuild(alias)
+        return alias
+
+    def tree_files(targets, built=False):
+        '''
+        Source files (those without a builder) in the dependency trees of
+        the given targets.  Or, when built is True, the files which are
+        built.
+        '''
+        seen = set()
+        files = []
+        stack = list(targets)
+        while stack:
+            node = stack.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            if node.has_builder():
+                stack.extend(node.children())
+                if built and isinstance(node, SCons.Node.FS.File):
+                    files.append(node.abspath)
+            elif not built and isinstance(node, SCons.Node.FS.File):
+                files.append(node.rfile().abspath)
+        return sorted(set(files))
+
+    def file_mtimes(files):
+        mtimes = {}
+        for f in files:
+            try:
+                mtimes[f] = os.stat(f).st_mtime
+            except OSError:
+                mtimes[f] = None
+        return mtimes
+
+    def read_until_prompt(child):
+        '''
+        Echo the output of an interactive scons until it prompts again
+        '''
+        buf = ''
+        while True:
+            data = os.read(child.stdout.fileno(), 4096)
+            if not data:
+                raise Exception('scons --interactive exited')
+            buf += data
+            lines = buf.split('\n')
+            for line in lines[:-1]:
+                print line
+            buf = lines[-1]
+            if buf.startswith('scons>>>'):
+                return
+
+    @env.AddMethod
+    def SizeProfiles(env, name='arduino-size-diff'):
+        '''
+        Write a size profile, <elf>.size.json, next to every ELF file built
+        with env by Sketch() or Elf() from here on (e.g., blah.size.json
+        for blah.elf).  The profile gives the flash and RAM used, the size
+        of each section, and the size of each symbol along with the object
+        and library (archive) which defined it.  The ELF files and the
+        objects and archives linked into them are read directly; no tools
+        are run.  The alias arduino-size-profiles builds the profiles.
+
+        The alias name compares two builds,
+
+            scons arduino-size-diff old=<baseline> new=<current> [top=N]
+
+        where old and new are each a profile, an ELF file or a directory.
+        Directories are searched for profiles, and the profiles with the
+        same path relative to each directory are compared, one per board.
+        The change in flash and RAM used and in each section is printed,
+        followed by the top N (10) growths by library, object and symbol.
+        '''
+        env['ARDUINO_SIZE_PROFILES'] = True
+        env.Append( BUILDERS = {
+            'SizeProfile' : Builder(
+                action = SCons.Action.Action(size_profile, 'Profiling sizes of $SOURCE'),
+                suffix = '.size.json', src_suffix = '.elf') } )
+
+        def diff(target, source, env):
+            if not ('old' in ARGUMENTS and 'new' in ARGUMENTS):
+                return 'usage: scons %s old=<profile|elf|dir> new=<profile|elf|dir> [top=N]' % name
+            old = env.Entry(ARGUMENTS['old']).abspath
+            new = env.Entry(ARGUMENTS['new']).abspath
+            top = int(ARGUMENTS.get('top', 10))
+            if os.path.isdir(old) and os.path.isdir(new):
+                old_files = profile_files(old)
+                new_files = profile_files(new)
+                for path in sorted(set(old_files) | set(new_files)):
+                    print '%s:' % path
+                    if not (path in old_files) or not (path in new_files):
+                        print '  only in %s' % (old if path in old_files else new)
+                        continue
+                    print_size_diff(load_profile(join(old, path)),
+                                    load_profile(join(new, path)), top)
+            else:
+                print_size_diff(load_profile(old), load_profile(new), top)
+            return 0
+
+        AlwaysBuild(env.Alias(name, [], diff))
+        return env
+
+    def profile_sizes(env, elfs):
+        '''
+        With ARDUINO_SIZE_PROFILES, declare the size profiles of elfs
+        '''
+        if env.get('ARDUINO_SIZE_PROFILES'):
+            for elf in elfs:
+                env.Alias('arduino-size-profiles', env.SizeProfile(elf))
+
+    def size_profile(target, source, env):
+        elf = source[0]
+        inputs = [ s for s in elf.sources
+                   if os.path.splitext(str(s))[1] in [ '.o', '.a' ] ]
+        profile = elf_profile(elf.abspath, elf.path, inputs)
+        if profile is None:
+            return '%s is not an ELF file' % elf
+        with open(target[0].abspath, 'w') as f:
+            json.dump(profile, f, indent=0, sort_keys=True)
+        return 0
+
+    def elf_profile(path, name, inputs=None):
+        '''
+        Size profile of the ELF file at path.  The symbols are attributed to
+        the objects and archives inputs when given.  Otherwise, local
+        symbols are attributed to their source file and globals to nothing.
+        '''
+        with open(path, 'rb') as f:
+            elf = read_elf(f.read())
+        if elf is None:
+            return None
+        sections, symbols = elf
+        if inputs is None:
+            inputs = []
+        globals_, locals_ = symbol_owners(inputs)
+
+        flash = 0
+        ram = 0
+        regions = {}
+        sizes = {}
+        for sname, stype, flags, size in sections:
+            if not (flags & 2) or size == 0:
+                continue
+            sizes[sname] = sizes.get(sname, 0) + size
+            region = ''
+            if stype != 8 and not (sname in NOT_MEMORY):
+                flash += size
+                region = 'flash'
+            if flags & 1 and not (sname in NOT_MEMORY):
+                ram += size
+                region = 'ram' if region == '' else 'flash+ram'
+            regions[sname] = region
+
+        profile = { 'elf'       : name,
+                    'flash'     : flash,
+                    'ram'       : ram,
+                    'sections'  : sizes,
+                    'symbols'   : {},
+                    'objects'   : {},
+                    'libraries' : {} }
+        entries = []
+        for sym, size, section, local, source in symbols:
+            if size == 0 or not (section in sizes):
+                continue
+            if local:
+                owners = locals_.get(sym, [])
+                if len(owners) > 1:
+                    stem = os.path.basename(source).split('.')[0]
+                    owners = [ o for o in owners
+                               if object_stem(o[0]) == stem ] or owners[:1]
+                if len(owners) > 0:
+                    obj, lib = owners[0]
+                elif len(inputs) == 0:
+                    obj, lib = source, ''
+                else:
+                    obj, lib = '', ''
+            else:
+                obj, lib = globals_.get(sym, ('', ''))
+            entries.append((sym, size, section, obj, lib))
+            obj = obj or '(other)'
+            profile['objects'][obj] = profile['objects'].get(obj, 0) + size
+            if lib:
+                profile['libraries'][lib] = profile['libraries'].get(lib, 0) + size
+
+        # Symbols are keyed by name, and by name and object for the local
+        # symbols sharing a name
+        names = {}
+        for entry in entries:
+            names[entry[0]] = names.get(entry[0], 0) + 1
+        for sym, size, section, obj, lib in entries:
+            key = sym if names[sym] == 1 else '%s [%s]' % (sym, obj)
+            profile['symbols'][key] = [ size, section, obj ]
+        return profile
+
+    def object_stem(path):
+        # 'lib.a(wiring_pulse.S.o)' --> 'wiring_pulse'
+        return os.path.basename(path.rstrip(')').split('(')[-1]).split('.')[0]
+
+    def symbol_owners(inputs):
+        '''
+        Map each symbol defined by the objects and archives in inputs to
+        where it is defined, (object, library).  Global symbols map to the
+        first definition; local symbols map to the list of objects defining
+        a symbol of that name.
+        '''
+        globals_ = {}
+        locals_ = {}
+        for node in inputs:
+            path = node.abspath
+            if str(node).endswith('.a'):
+                members = [ ('%s(%s)' % (node.path, member), data)
+                            for member, data in archive_members(path) ]
+                lib = node.path
+            else:
+                with open(path, 'rb') as f:
+                    members = [ (node.path, f.read()) ]
+                lib = ''
+            for obj, data in members:
+                elf = read_elf(data)
+                if elf is None:
+                    continue
+                for sym, size, section, local, source in elf[1]:
+                    if section is None:
+                        continue
+                    if local:
+                        locals_.setdefault(sym, []).append((obj, lib))
+                    elif not (sym in globals_):
+                        globals_[sym] = (obj, lib)
+        return globals_, locals_
+
+    def archive_members(path):
+        '''
+        Return (name, contents) for each member of the ar archive at path.
+        The members of a thin archive (see ThinArchives()) are read from
+        the files it refers to.
+        '''
+        with open(path, 'rb') as f:
+            data = f.read()
+        thin = data.startswith('!<thin>\n')
+        if not (thin or data.startswith('!<arch>\n')):
+            return []
+        members = []
+        names = ''
+        pos = 8
+        while pos + 60 <= len(data):
+            header = data[pos:pos + 60]
+            name = header[:16].rstrip()
+            size = int(header[48:58])
+            pos += 60
+            if name in [ '/', '/SYM64/', '//' ]:
+                # Symbol and long name tables are stored even in thin archives
+                if name == '//':
+                    names = data[pos:pos + size]
+                pos += size + (size & 1)
+                continue
+            if name.startswith('/'):
+                # GNU long name: offset into the long name table
+                start = int(name[1:])
+                name = names[start:names.index('/\n', start)]
+            elif name.endswith('/'):
+                name = name[:-1]
+            if thin:
+                try:
+                    with open(join(os.path.dirname(path), name), 'rb') as f:
+                        members.append((name, f.read()))
+                except IOError:
+                    pass
+            else:
+                members.append((name, data[pos:pos + size]))
+                pos += size + (size & 1)
+        return members
+
+    def read_elf(data):
+        '''
+        Read the section headers and symbol table of an ELF file, 32 or
+        64 bit of either byte order.  Returns (sections, symbols) where
+        sections lists (name, type, flags, size) and symbols lists (name,
+        size, section name, local, source file) for the function and data
+        symbols; section is None for undefined symbols and source file is
+        the file symbol preceding a local symbol.  None is returned if data
+        is not an ELF file.
+        '''
+        if data[:4] != '\x7fELF':
+            return None
+        order = '<' if data[5] == '\x01' else '>'
+        if data[4] == '\x02':
+            header, section, symbol = 'HHIQQQIHHHHHH', 'IIQQQQIIQQ', 'IBBHQQ'
+        else:
+            header, section, symbol = 'HHIIIIIHHHHHH', 'IIIIIIIIII', 'IIIBBH'
+        fields = struct.unpack_from(order + header, data, 16)
+        shoff, shentsize, shnum, shstrndx = fields[5], fields[10], fields[11], fields[12]
+        headers = [ struct.unpack_from(order + section, data, shoff + i * shentsize)
+                    for i in range(shnum) ]
+
+        def string(offset, table):
+            start = headers[table][4] + offset
+            return data[start:data.index('\0', start)]
+
+        names = [ string(h[0], shstrndx) for h in headers ]
+        sections = [ (names[i], h[1], h[2], h[5]) for i, h in enumerate(headers) ]
+
+        symbols = []
+        for h in headers:
+            if h[1] != 2:                   # SHT_SYMTAB
+                continue
+            size = struct.calcsize(order + symbol)
+            source = ''
+            for offset in range(h[4], h[4] + h[5], size):
+                entry = struct.unpack_from(order + symbol, data, offset)
+                if data[4] == '\x02':
+                    st_name, info, other, shndx, value, st_size = entry
+                else:
+                    st_name, value, st_size, info, other, shndx = entry
+                kind = info & 0xf
+                if kind == 4:               # STT_FILE
+                    source = string(st_name, h[6])
+                    continue
+                if not (kind in [ 1, 2 ]):  # STT_OBJECT, STT_FUNC
+                    continue
+                if shndx == 0 or shndx >= 0xff00:
+                    where = None if shndx == 0 else ''
+                else:
+                    where = names[shndx]
+                symbols.append((string(st_name, h[6]), st_size, where,
+                                (info >> 4) == 0, source))
+        return sections, symbols
+
+    def profile_files(path):
+        '''
+        Size profiles within the directory path, relative to it
+        '''
+        found = []
+        for root, dirs, files in os.walk(path):
+            for f in files:
+                if f.endswith('.size.json'):
+                    found.append(join(root, f)[len(path) + 1:])
+        return found
+
+    def load_profile(path):
+        if path.endswith('.json'):
+            with open(path) as f:
+                return json.load(f)
+        profile = elf_profile(path, path)
+        if profile is None:
+            raise Exception('%s is neither a size profile nor an ELF file' % path)
+        return profile
+
+    def print_size_diff(old, new, top):
+        def change(a, b):
+            return '%d -> %d (%+d)' % (a, b, b - a)
+
+        print '  flash %s, RAM %s' % (change(old['flash'], new['flash']),
+                                      change(old['ram'], new['ram']))
+        changed = [ (s, old['sections'].get(s, 0), new['sections'].get(s, 0))
+                    for s in sorted(set(old['sections']) | set(new['sections'])) ]
+        changed = [ '%s %+d' % (s, b - a) for s, a, b in changed if a != b ]
+        if len(changed) > 0:
+            print '  sections: ' + ', '.join(changed)
+
+        for title, key in [ ('library', 'libraries'), ('object', 'objects'),
+                            ('symbol', 'symbols') ]:
+            a, b = old[key], new[key]
+            if key == 'symbols':
+                a = dict([ (k, v[0]) for k, v in a.items() ])
+                b = dict([ (k, v[0]) for k, v in b.items() ])
+            deltas = [ (b.get(k, 0) - a.get(k, 0), k) for k in set(a) | set(b) ]
+            growth = sorted([ d for d in deltas if d[0] > 0 ],
+                            key=lambda d: (-d[0], d[1]))
+            shrunk = len([ d for d in deltas if d[0] < 0 ])
+            if len(growth) == 0 and shrunk == 0:
+                continue
+            print '  top growth by %s (%d grew, %d shrank):' % (title, len(growth), shrunk)
+            for delta, k in growth[:top]:
+                note = ''
+                if not (k in a):
+                    note = ' (new)'
+                print '    %+7d  %s%s' % (delta, k, note)
+
+    @env.AddMethod
+    def BuildTrends(env, path='#.arduino-trends.jsonl', name='arduino-trend-check',
+                    window=10, time_tolerance=0.25, size_tolerance=0):
+        '''
+        Append a record of each board's build to the JSON lines file path
+        when scons exits: the board as ConfigureBoard() resolved it, the
+        git commit, the seconds spent configuring the board, compiling,
+        archiving and linking (summed over the targets built), the wall
+        clock time of the build, the number of objects rebuilt and the
+        flash and RAM used by each of the board's ELF files.  Targets
+        retrieved from a cache are not counted, and builds which rebuild
+        nothing for a board add no record for it.
+
+        The alias name checks the latest record for each board against
+        the median of the window records before it and fails if
+
+          * the compile time per object or link time per link grew by
+            more than time_tolerance (a fraction), or
+          * an ELF file uses more than size_tolerance bytes more flash or
+            RAM than it did.
+
+        Call this before building anything, e.g., along with ConfigureBoard().
+        '''
+        trends = tool_state(env, 'trends')
+        if 'path' in trends:
+            return env
+        trends['path'] = env.File(path).abspath
+        trends['start'] = time.time()
+        trends['run'] = {}
+
+        task_execute = SCons.Taskmaster.Task.execute
+
+        def execute(self):
+            start = time.time()
+            task_execute(self)
+            elapsed = time.time() - start
+            for t in self.targets:
+                # Targets retrieved from a CacheDir() were not built
+                if isinstance(t, SCons.Node.FS.File) and not getattr(t, 'cached', 0):
+                    trends['run'][t] = elapsed / len(self.targets)
+
+        SCons.Taskmaster.Task.execute = execute
+        atexit.register(record_trends, env, trends)
+
+        def check(target, source, env):
+            records = load_trends(trends['path'])
+            if len(records) == 0:
+                return '%s: no build records in %s' % (name, trends['path'])
+            failures = check_trends(records, window, time_tolerance, size_tolerance)
+            for failure in failures:
+                print '%s: %s' % (name, failure)
+            if len(failures) > 0:
+                return '%s: %d regression(s)' % (name, len(failures))
+            print '%s: no regressions' % name
+            return 0
+
+        AlwaysBuild(env.Alias(name, [], check))
+        return env
+
+    def record_trends(env, trends):
+        run = trends['run']
+        if len(run) == 0 or GetOption('no_exec'):
+            return
+        wall = time.time() - trends['start']
+        artifacts = board_artifacts(env)
+        commit = git_commit(env)
+        stamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+        records = []
+        for board, (info, seconds) in sorted(tool_state(env, 'configured').items()):
+            nodes = [ n for n, b in artifacts.items() if b == board ]
+            built = [ n for n in nodes if n in run ]
+            if len(built) == 0:
+                continue
+            times = {}
+            counts = {}
+            for n in built:
+                kind = artifact_kind(n)
+                times[kind] = times.get(kind, 0.0) + run[n]
+                counts[kind] = counts.get(kind, 0) + 1
+            firmware = {}
+            for n in sorted(nodes, key=str):
+                if artifact_kind(n) == 'elf' and os.path.exists(n.abspath):
+                    profile = elf_profile(n.abspath, n.path)
+                    if not (profile is None):
+                        firmware[n.path] = { 'flash' : profile['flash'],
+                                             'ram'   : profile['ram'] }
+            records.append({
+                'time'              : stamp,
+                'commit'            : commit,
+                'board'             : board,
+                'name'              : info.name,
+                'arch'              : info.arch,
+                'version'           : info.version,
+                'mcu'               : info.mcu,
+                'f_cpu'             : info.f_cpu,
+                'core'              : info.core,
+                'variant'           : info.variant,
+                'configure_seconds' : round(seconds, 4),
+                'compile_seconds'   : round(times.get('object', 0.0), 4),
+                'archive_seconds'   : round(times.get('archive', 0.0), 4),
+                'link_seconds'      : round(times.get('elf', 0.0), 4),
+                'wall_seconds'      : round(wall, 4),
+                'objects_rebuilt'   : counts.get('object', 0),
+                'links'             : counts.get('elf', 0),
+                'firmware'          : firmware })
+
+        if len(records) > 0:
+            with open(trends['path'], 'a') as f:
+                for record in records:
+                    f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def git_commit(env):
+        try:
+            proc = subprocess.Popen([ 'git', 'rev-parse', 'HEAD' ],
+                                    cwd=env.Dir('#').abspath,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out = proc.communicate()[0]
+        except OSError:
+            return ''
+        if proc.returncode != 0:
+            return ''
+        return out.strip()
+
+    def load_trends(path):
+        records = []
+        try:
+            with open(path) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        records.append(json.loads(line))
+        except IOError:
+            pass
+        return records
+
+    def median(values):
+        values = sorted(values)
+        middle = len(values) / 2
+        if len(values) % 2:
+            return values[middle]
+        return (values[middle - 1] + values[middle]) / 2.0
+
+    def check_trends(records, window, time_tolerance, size_tolerance):
+        '''
+        Compare the latest record of each board with the median of the
+        window records for the board (and the same mcu and clock) before
+        it.  Returns a description of each regression found.
+        '''
+        boards = {}
+        for r in records:
+            boards.setdefault((r['board'], r['mcu'], r['f_cpu']), []).append(r)
+
+        failures = []
+        for key in sorted(boards):
+            history = boards[key]
+            latest = history[-1]
+            baseline = history[-window - 1:-1]
+            if len(baseline) == 0:
+                continue
+            board = latest['board']
+
+            for what, seconds, count in [ ('compile time per object',
+                                           'compile_seconds', 'objects_rebuilt'),
+                                          ('link time', 'link_seconds', 'links') ]:
+                rates = [ r[seconds] / r[count] for r in baseline if r[count] > 0 ]
+                if latest[count] == 0 or len(rates) == 0:
+                    continue
+                now = latest[seconds] / latest[count]
+                before = median(rates)
+                if before > 0 and now > before * (1 + time_tolerance):
+                    failures.append('%s: %s %.3fs, baseline %.3fs (+%.0f%%)' % (
+                        board, what, now, before, 100 * (now / before - 1)))
+
+            for elf, sizes in sorted(latest['firmware'].items()):
+                for region in [ 'flash', 'ram' ]:
+                    before = [ r['firmware'][elf][region] for r in baseline
+                               if elf in r['firmware'] ]
+                    if len(before) == 0:
+                        continue
+                    before = median(before)
+                    if sizes[region] > before + size_tolerance:
+                        failures.append('%s: %s %s %d bytes, baseline %d (+%d)' % (
+                            board, elf, region, sizes[region], before,
+                            sizes[region] - before))
+        return failures
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+'''
+Time scons plus arduino.py on projects shaped like example_simple and
+example_variant, and on a synthetic project of 1,000 source files.
+
+Everything runs offline.  A fake ARDUINO_HOME (and, for sam, a Boards
+Manager tree) is fabricated in a scratch directory with stub gcc, ar,
+objcopy and size scripts which sleep for --work seconds, to simulate
+the compiler, and then write their output file.  The arduino.py next to
+this directory is the one timed.
+
+For each project the harness times
+
+  full    a clean -j build
+  null    a build with nothing to do
+  touch   a build after editing one source file
+  read    the SConscript reading phase of the null build (--debug=time)
+
+and writes the runs and medians to a JSON file.  Given --compare with
+an earlier JSON file, medians are compared and the exit status is 1 if
+any is more than --threshold percent slower.
+
+  python benchmark/benchmark.py -o before.json
+  ... change arduino.py ...
+  python benchmark/benchmark.py -o after.json --compare before.json
+'''
+
+import os
+import sys
+import re
+import json
+import time
+import shutil
+import tempfile
+import platform
+import subprocess
+from optparse import OptionParser
+from os.path import join
+
+TOOL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STUB = '''#!/bin/sh
+# Stand in for the gcc tool chain: simulate work, then write the output
+case "$1" in -dumpversion) echo 4.8.1; exit 0;; esac
+sleep %(work)s
+out=""; prev=""; last=""
+for a in "$@"; do
+  if [ "$prev" = "-o" ]; then out="$a"; fi
+  prev="$a"; last="$a"
+done
+case "$(basename "$0")" in
+  *-ar) for a in "$@"; do case "$a" in *.a) out="$a"; break;; esac; done;;
+  *-objcopy) out="$last";;
+  *-size) echo "   text    data     bss     dec     hex filename"
+          echo "   1000     100     200    1300     514 $last"; exit 0;;
+  *-ranlib) exit 0;;
+esac
+if [ -z "$out" ]; then
+  # gcc -c with several sources writes their objects here
+  for a in "$@"; do
+    case "$a" in *.c|*.cpp) b=$(basename "$a"); echo "$a" > "${b%%.*}.o";; esac
+  done
+fi
+[ -n "$out" ] && echo "$*" > "$out"
+exit 0
+'''
+
+PLATFORM = '''name=Arduino %(ARCH)s Boards
+version=%(version)s
+compiler.warning_flags=-w
+compiler.path={runtime.tools.%(gcc)s.path}/bin/
+compiler.c.cmd=%(prefix)sgcc
+compiler.c.flags=-c -g -Os {compiler.warning_flags} -ffunction-sections -fdata-sections -MMD
+compiler.c.elf.flags={compiler.warning_flags} -Os -Wl,--gc-sections
+compiler.c.elf.cmd=%(prefix)sgcc
+compiler.S.flags=-c -g -x assembler-with-cpp
+compiler.cpp.cmd=%(prefix)sg++
+compiler.cpp.flags=-c -g -Os {compiler.warning_flags} -fno-exceptions -ffunction-sections -fdata-sections -fno-threadsafe-statics -MMD
+compiler.ar.cmd=%(prefix)sar
+compiler.ar.flags=rcs
+compiler.objcopy.cmd=%(prefix)sobjcopy
+compiler.elf2hex.flags=-O ihex -R .eeprom
+compiler.elf2hex.cmd=%(prefix)sobjcopy
+compiler.size.cmd=%(prefix)ssize
+recipe.c.o.pattern="{compiler.path}{compiler.c.cmd}" {compiler.c.flags} -mmcu={build.mcu} -DF_CPU={build.f_cpu} -DARDUINO={runtime.ide.version} -DARDUINO_{build.board} -DARDUINO_ARCH_{build.arch} {build.extra_flags} {includes} "{source_file}" -o "{object_file}"
+recipe.cpp.o.pattern="{compiler.path}{compiler.cpp.cmd}" {compiler.cpp.flags} -mmcu={build.mcu} -DF_CPU={build.f_cpu} -DARDUINO={runtime.ide.version} -DARDUINO_{build.board} -DARDUINO_ARCH_{build.arch} {build.extra_flags} {includes} "{source_file}" -o "{object_file}"
+recipe.S.o.pattern="{compiler.path}{compiler.c.cmd}" {compiler.S.flags} -mmcu={build.mcu} -DF_CPU={build.f_cpu} -DARDUINO={runtime.ide.version} -DARDUINO_{build.board} -DARDUINO_ARCH_{build.arch} {build.extra_flags} {includes} "{source_file}" -o "{object_file}"
+recipe.ar.pattern="{compiler.path}{compiler.ar.cmd}" {compiler.ar.flags} "{build.path}/{archive_file}" "{object_file}"
+recipe.c.combine.pattern="{compiler.path}{compiler.c.elf.cmd}" {compiler.c.elf.flags} -mmcu={build.mcu} -o "{build.path}/{build.project_name}.elf" {object_files} "{build.path}/{archive_file}" "-L{build.path}" -lm
+recipe.objcopy.hex.pattern="{compiler.path}{compiler.elf2hex.cmd}" {compiler.elf2hex.flags} "{build.path}/{build.project_name}.elf" "{build.path}/{build.project_name}.hex"
+recipe.objcopy.bin.pattern="{compiler.path}{compiler.elf2hex.cmd}" -O binary "{build.path}/{build.project_name}.elf" "{build.path}/{build.project_name}.bin"
+recipe.size.pattern="{compiler.path}{compiler.size.cmd}" -A "{build.path}/{build.project_name}.elf"
+tools.avrdude.path={runtime.tools.avrdude.path}
+tools.avrdude.cmd.path={path}/bin/avrdude
+tools.avrdude.config.path={path}/etc/avrdude.conf
+tools.avrdude.upload.params.quiet=-q -q
+tools.bossac.path={runtime.tools.bossac.path}
+tools.bossac.cmd=bossac
+tools.bossac.upload.params.quiet=
+'''
+
+BOARDS = '''%(board)s.name=Benchmark board
+%(board)s.upload.tool=%(upload)s
+%(board)s.build.mcu=%(mcu)s
+%(board)s.build.f_cpu=%(f_cpu)s
+%(board)s.build.board=%(macro)s
+%(board)s.build.core=arduino
+%(board)s.build.variant=%(variant)s
+'''
+
+ARCHES = {
+    'avr' : { 'board' : 'uno', 'upload' : 'avrdude', 'mcu' : 'atmega328p',
+              'f_cpu' : '16000000L', 'macro' : 'AVR_UNO', 'variant' : 'standard',
+              'gcc' : 'avr-gcc', 'prefix' : 'avr-', 'version' : '1.6.4' },
+    'sam' : { 'board' : 'arduino_due_x', 'upload' : 'bossac', 'mcu' : 'cortex-m3',
+              'f_cpu' : '84000000L', 'macro' : 'SAM_DUE', 'variant' : 'arduino_due_x',
+              'gcc' : 'arm-none-eabi-gcc', 'prefix' : 'arm-none-eabi-',
+              'version' : '1.6.4' } }
+
+CORE_SOURCES = [ 'CDC.cpp', 'HardwareSerial.cpp', 'HardwareSerial0.cpp',
+    'IPAddress.cpp', 'Print.cpp', 'Stream.cpp', 'Tone.cpp', 'USBCore.cpp',
+    'WMath.cpp', 'WString.cpp', 'abi.cpp', 'main.cpp', 'new.cpp',
+    'WInterrupts.c', 'hooks.c', 'wiring.c', 'wiring_analog.c',
+    'wiring_digital.c', 'wiring_pulse.c', 'wiring_shift.c' ]
+
+SCONSTRUCT = '''import os
+from os.path import join
+
+arduino_version = int(os.environ['ARDUINO_VERSION'])
+arduino_arch    = os.environ['ARDUINO_ARCH']
+arduino_home    = os.environ['ARDUINO_HOME']
+%(variant)s
+drop_list = [ ('-o', 1), ('-w', 0), ('-MMD', 0) ]
+
+options = {
+  'cc_flags_drop_list'  : drop_list,
+  'cxx_flags_drop_list' : drop_list }
+
+env = Environment(
+    tools = ['default', 'arduino'],
+    toolpath = [ %(toolpath)r ]%(variant_dir)s )
+
+# Build the core and libraries without leaving .o and .a files in the
+# Arduino tree
+Repository(%(repository)r)
+
+env.ConfigureBoard(arduino_version, arduino_arch, %(board)r, options)
+core_lib = env.ArduinoCore()
+serial_lib = env.ArduinoLibrary('SoftwareSerial')
+%(body)s
+'''
+
+def write(path, text):
+    d = os.path.dirname(path)
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    with open(path, 'w') as f:
+        f.write(text)
+
+def source_text(name, includes=''):
+    '''
+    A small C or C++ source, unique to name
+    '''
+    func = re.sub(r'\W', '_', name)
+    return '%s#include <stdint.h>\nint %s(int x) { return x + %d; }\n' % (
+        includes, func, len(name))
+
+def fabricate_arduino(root, arch, work):
+    '''
+    Create a fake Arduino install under root for arch.  Returns the
+    environment variables scons needs to use it and the directory of
+    the platform's boards.txt.
+    '''
+    info = dict(ARCHES[arch])
+    info['ARCH'] = arch.upper()
+    info['work'] = work
+    env = { 'ARDUINO_ARCH' : arch }
+
+    if arch == 'avr':
+        home = join(root, 'arduino')
+        hardware = join(home, 'hardware', 'arduino', 'avr')
+        bin_dir = join(home, 'hardware', 'tools', 'avr', 'bin')
+        env['ARDUINO_VERSION'] = '164'
+        env['ARDUINO_HOME'] = home
+    else:
+        # A Boards Manager install, found through the package index
+        packages = join(root, 'arduino15')
+        home = join(packages, 'packages', 'arduino')
+        hardware = join(home, 'hardware', arch, info['version'])
+        gcc = join(home, 'tools', info['gcc'], '4.8.3-2014q1')
+        bin_dir = join(gcc, 'bin')
+        write(join(packages, 'package_index.json'), json.dumps({ 'packages' : [
+            { 'name' : 'arduino', 'platforms' : [
+                { 'architecture' : arch, 'version' : info['version'],
+                  'toolsDependencies' : [ { 'packager' : 'arduino',
+                      'name' : info['gcc'], 'version' : '4.8.3-2014q1' } ] } ] } ] }))
+        env['ARDUINO_VERSION'] = info['version'].replace('.', '')
+        env['ARDUINO_HOME'] = home
+        env['ARDUINO_PACKAGES'] = packages
+        write(join(hardware, 'system', 'libsam', 'include', 'sam.h'), '\n')
+
+    write(join(hardware, 'platform.txt'), PLATFORM % info)
+    write(join(hardware, 'boards.txt'), BOARDS % info)
+    core = join(hardware, 'cores', 'arduino')
+    write(join(core, 'Arduino.h'), '#include <stdint.h>\n')
+    for name in CORE_SOURCES:
+        write(join(core, name), source_text(name, '#include "Arduino.h"\n'))
+    if arch == 'avr':
+        write(join(core, 'wiring_pulse.S'), '\n')
+    else:
+        for sub in [ 'avr', 'USB' ]:
+            write(join(core, sub, sub + '.cpp'), source_text(sub))
+        write(join(hardware, 'variants', info['variant'], 'variant.cpp'),
+              source_text('variant'))
+    write(join(hardware, 'variants', info['variant'], 'pins_arduino.h'), '\n')
+    lib = join(hardware, 'libraries', 'SoftwareSerial')
+    write(join(lib, 'SoftwareSerial.h'), '#include <Arduino.h>\n')
+    write(join(lib, 'SoftwareSerial.cpp'),
+          source_text('SoftwareSerial', '#include "SoftwareSerial.h"\n'))
+
+    for tool in [ 'gcc', 'g++', 'ar', 'ranlib', 'objcopy', 'size' ]:
+        path = join(bin_dir, info['prefix'] + tool)
+        write(path, STUB % info)
+        os.chmod(path, 0o755)
+    return env, hardware
+
+def fabricate_project(root, shape, arch, hardware):
+    '''
+    Create a project of the given shape: simple, variant or synthetic.
+    Returns the project directory and the file the touch test edits.
+    '''
+    board = ARCHES[arch]['board']
+    top = join(root, shape)
+    fields = { 'toolpath' : TOOL_DIR, 'board' : board, 'repository' : hardware,
+               'variant' : '', 'variant_dir' : '' }
+
+    if shape == 'simple':
+        fields['body'] = "env.Sketch('blah', ['blah.cpp', serial_lib, core_lib])"
+        write(join(top, 'SConstruct'), SCONSTRUCT % fields)
+        write(join(top, 'blah.cpp'), source_text('blah', '#include <Arduino.h>\n'))
+        return top, join(top, 'blah.cpp')
+
+    # Shaped like example_variant: sources in src/, built in build/<board>
+    write(join(top, 'SConstruct'),
+          "import os\n"
+          "os.environ['VARIANT_DIR'] = os.path.join('build', %r)\n"
+          "SConscript(['src/SConscript'], variant_dir=os.environ['VARIANT_DIR'])\n"
+          % board)
+    fields['variant_dir'] = ",\n    VARIANT_DIR = os.environ['VARIANT_DIR']"
+    src = join(top, 'src')
+
+    if shape == 'variant':
+        fields['body'] = '\n'.join([
+            "objs = env.Object(Glob('*.cpp'))",
+            "another_lib = env.Library('max31855', Glob('libraries/MAX31855/*.cpp'))",
+            "env.Elf('blah.elf', [ objs, another_lib, serial_lib, core_lib])",
+            "env.Hex('blah.hex', 'blah.elf')" ])
+        write(join(src, 'foo.h'), '\n')
+        for name in [ 'blah.cpp', 'foo.cpp' ]:
+            write(join(src, name), source_text(name, '#include "foo.h"\n'))
+        lib = join(src, 'libraries', 'MAX31855')
+        write(join(lib, 'MAX31855.h'), '\n')
+        write(join(lib, 'MAX31855.cpp'), source_text('MAX31855', '#include "MAX31855.h"\n'))
+        write(join(src, 'SConscript'), SCONSTRUCT % fields)
+        return top, join(src, 'foo.cpp')
+
+    # synthetic: 9 libraries of 100 files and 100 sketch files
+    body = [ 'libs = []' ]
+    for i in range(9):
+        lib = join(src, 'libraries', 'Lib%d' % i)
+        write(join(lib, 'Lib%d.h' % i), '#include <Arduino.h>\n')
+        for j in range(100):
+            name = 'lib%d_%03d.cpp' % (i, j)
+            write(join(lib, name), source_text(name, '#include "Lib%d.h"\n' % i))
+        body.append("libs.append(env.Library('Lib%d', Glob('libraries/Lib%d/*.cpp')))" % (i, i))
+    for j in range(100):
+        name = 'sketch_%03d.cpp' % j
+        write(join(src, name), source_text(name, '#include <Arduino.h>\n'))
+    body.append("env.Sketch('synthetic', [ Glob('*.cpp'), libs, serial_lib, core_lib ])")
+    fields['body'] = '\n'.join(body)
+    write(join(src, 'SConscript'), SCONSTRUCT % fields)
+    return top, join(src, 'sketch_050.cpp')
+
+def run_scons(scons, top, env, args):
+    '''
+    Run scons in top, returning the elapsed seconds and its output
+    '''
+    start = time.time()
+    proc = subprocess.Popen(scons + [ '-Q' ] + args, cwd=top, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = proc.communicate()[0]
+    elapsed = time.time() - start
+    if not isinstance(out, str):
+        out = out.decode('utf-8', 'replace')
+    if proc.returncode != 0:
+        sys.stderr.write(out)
+        raise Exception('scons failed in %s' % top)
+    return elapsed, out
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    if n % 2:
+        return values[n // 2]
+    return (values[n // 2 - 1] + values[n // 2]) / 2.0
+
+def bench_project(scons, top, touch, env, jobs, repeat):
+    '''
+    Time the full, null, touch and read scenarios for one project
+    '''
+    runs = { 'full' : [], 'null' : [], 'touch' : [], 'read' : [] }
+    jobs = [ '-j', str(jobs) ]
+    for i in range(repeat):
+        run_scons(scons, top, env, [ '-c' ])
+        runs['full'].append(run_scons(scons, top, env, jobs)[0])
+
+        elapsed, out = run_scons(scons, top, env, jobs + [ '--debug=time' ])
+        runs['null'].append(elapsed)
+        m = re.search(r'Total SConscript file execution time: ([0-9.]+)', out)
+        if m:
+            runs['read'].append(float(m.group(1)))
+
+        with open(touch, 'a') as f:
+            f.write('// touched %d %f\n' % (i, time.time()))
+        runs['touch'].append(run_scons(scons, top, env, jobs)[0])
+
+    return dict([ (name, { 'runs' : values, 'median' : median(values) })
+                  for name, values in runs.items() if len(values) > 0 ])
+
+def scons_version(scons):
+    try:
+        out = subprocess.Popen(scons + [ '--version' ], stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT).communicate()[0]
+    except OSError:
+        return ''
+    if not isinstance(out, str):
+        out = out.decode('utf-8', 'replace')
+    m = re.search(r'engine: v(\d+(?:\.\d+)*)', out)
+    return m.group(1) if m else ''
+
+def print_results(results):
+    print('%-16s %9s %9s %9s %9s' % ('project', 'read', 'null', 'touch', 'full'))
+    for project in sorted(results.keys()):
+        print('%-16s' % project + ''.join([
+            ' %8.3fs' % results[project][test]['median']
+            if test in results[project] else ' %9s' % '-'
+            for test in [ 'read', 'null', 'touch', 'full' ] ]))
+
+def compare(baseline, results, threshold):
+    '''
+    Print the medians against those of baseline.  Returns True if none
+    is more than threshold percent slower.
+    '''
+    okay = True
+    print('%-16s %-6s %10s %10s %8s' % ('project', 'test', 'before', 'after', 'change'))
+    for project in sorted(results.keys()):
+        for test in [ 'read', 'null', 'touch', 'full' ]:
+            if not (test in results[project]) or \
+               not (test in baseline.get(project, {})):
+                continue
+            before = baseline[project][test]['median']
+            after = results[project][test]['median']
+            change = 100.0 * (after - before) / before if before > 0 else 0.0
+            flag = ''
+            if change > threshold:
+                flag = '  SLOWER'
+                okay = False
+            print('%-16s %-6s %9.3fs %9.3fs %+7.1f%%%s' % (
+                project, test, before, after, change, flag))
+    return okay
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output', default='benchmark.json',
+                      help='JSON file to write the results to [%default]')
+    parser.add_option('--compare', metavar='FILE',
+                      help='earlier results to compare against')
+    parser.add_option('--threshold', type='float', default=10.0,
+                      help='percent slowdown failing --compare [%default]')
+    parser.add_option('--projects', default='simple,variant,synthetic',
+                      help='projects to time [%default]')
+    parser.add_option('--arch', default='avr',
+                      help='architectures, avr and/or sam [%default]')
+    parser.add_option('-j', '--jobs', type='int', default=4,
+                      help='scons -j for the builds [%default]')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='times to run each test [%default]')
+    parser.add_option('--work', default='0.01',
+                      help='seconds each stub tool sleeps [%default]')
+    parser.add_option('--scons', default='scons',
+                      help='scons command [%default]')
+    parser.add_option('--keep', action='store_true',
+                      help='keep the scratch directory')
+    opts, args = parser.parse_args()
+
+    scons = opts.scons.split()
+    scratch = tempfile.mkdtemp(prefix='arduino-bench-')
+    results = {}
+    try:
+        for arch in opts.arch.split(','):
+            env = dict(os.environ)
+            for name in [ 'ARDUINO_TOOLS', 'ARDUINO_PACKAGES', 'VARIANT_DIR' ]:
+                env.pop(name, None)
+            settings, hardware = fabricate_arduino(join(scratch, arch), arch, opts.work)
+            env.update(settings)
+            for shape in opts.projects.split(','):
+                name = '%s-%s' % (shape, arch)
+                sys.stderr.write('timing %s\n' % name)
+                top, touch = fabricate_project(join(scratch, arch), shape, arch,
+                                               hardware)
+                results[name] = bench_project(scons, top, touch, env,
+                                              opts.jobs, opts.repeat)
+    finally:
+        if opts.keep:
+            sys.stderr.write('scratch directory kept in %s\n' % scratch)
+        else:
+            shutil.rmtree(scratch, True)
+
+    report = { 'meta' : { 'date' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+                          'python' : platform.python_version(),
+                          'scons' : scons_version(scons),
+                          'platform' : sys.platform,
+                          'jobs' : opts.jobs, 'repeat' : opts.repeat,
+                          'work' : opts.work },
+               'results' : results }
+    with open(opts.output, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+
+    print_results(results)
+    if opts.compare:
+        with open(opts.compare) as f:
+            baseline = json.load(f)['results']
+        print('')
+        if not compare(baseline, results, opts.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+'''
+Build tests of arduino.py.  Like the benchmark, they run scons on small
+projects against a fake Arduino install (see benchmark/benchmark.py)
+whose stub tools write their command line to their output file, so the
+tests can check how each file was built.
+
+  python test/test_arduino.py
+
+scons is run as "scons" unless SCONS names another command.
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+from os.path import join
+
+sys.path.insert(0, join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'benchmark'))
+from benchmark import TOOL_DIR, ARCHES, BOARDS, write, source_text, fabricate_arduino
+
+SCONSTRUCT = '''import os
+drop_list = [ ('-o', 1), ('-w', 0), ('-MMD', 0) ]
+options = { 'cc_flags_drop_list'  : drop_list,
+            'cxx_flags_drop_list' : drop_list }
+env = Environment(tools = ['default', 'arduino'], toolpath = [ %(toolpath)r ])
+%(body)s
+'''
+
+# A second avr board, differing from uno in everything ConfigureBoard() sets
+NANO = dict(ARCHES['avr'], board='nano', mcu='atmega168', f_cpu='8000000L',
+            macro='AVR_NANO', variant='eightanaloginputs')
+
+class ArduinoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp(prefix='arduino-test-')
+        self.env = dict(os.environ)
+        for name in [ 'ARDUINO_TOOLS', 'ARDUINO_PACKAGES', 'VARIANT_DIR' ]:
+            self.env.pop(name, None)
+        settings, self.hardware = fabricate_arduino(self.scratch, 'avr', '0')
+        self.env.update(settings)
+        with open(join(self.hardware, 'boards.txt'), 'a') as f:
+            f.write(BOARDS % NANO)
+        write(join(self.hardware, 'variants', NANO['variant'], 'pins_arduino.h'), '\n')
+        self.top = join(self.scratch, 'project')
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch, True)
+
+    def project(self, body, files={}):
+        write(join(self.top, 'SConstruct'),
+              SCONSTRUCT % { 'toolpath' : TOOL_DIR, 'body' : body })
+        for name, text in files.items():
+            write(join(self.top, name), text)
+
+    def scons(self, *args, **kw):
+        '''
+        Run scons in the project, checking it exits with status (0
+        unless given), and return its output
+        '''
+        scons = os.environ.get('SCONS', 'scons').split()
+        proc = subprocess.Popen(scons + [ '-Q' ] + list(args), cwd=self.top,
+                                env=self.env, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        out = proc.communicate()[0]
+        if not isinstance(out, str):
+            out = out.decode('utf-8', 'replace')
+        self.assertEqual(proc.returncode, kw.get('status', 0), out)
+        return out
+
+    def boards_manager(self):
+        '''
+        Add a Boards Manager install of sam and point the environment at
+        it; returns its hardware directory
+        '''
+        settings, hardware = fabricate_arduino(join(self.scratch, 'sam'), 'sam', '0')
+        self.env.update(settings)
+        return hardware
+
+    def built_with(self, path, suffix):
+        '''
+        The command lines the stub tools wrote to the files with suffix
+        under path, relative to the project
+        '''
+        commands = {}
+        for dirpath, dirnames, filenames in os.walk(join(self.top, path)):
+            for name in filenames:
+                if name.endswith(suffix):
+                    with open(join(dirpath, name)) as f:
+                        commands[os.path.relpath(join(dirpath, name), self.top)] = f.read()
+        self.assertTrue(commands, 'no %s files built in %s' % (suffix, path))
+        return commands
+
+    def test_examples_after_configuring_another_board(self):
+        self.project('\n'.join([
+            "env.ConfigureBoard(164, 'avr', 'uno', options)",
+            "env.CompileExamples(['mylibs/Foo'], ['nano'], options=options)" ]),
+            { 'mylibs/Foo/Foo.h' : '\n',
+              'mylibs/Foo/Foo.cpp' : source_text('Foo', '#include "Foo.h"\n'),
+              'mylibs/Foo/examples/Hello/Hello.ino' :
+                  '#include <Foo.h>\nvoid setup() {}\nvoid loop() {}\n' })
+        self.scons('arduino-examples')
+        for name, command in self.built_with('build/examples/nano', '.o').items():
+            self.assertTrue('-mmcu=atmega168' in command, name + ': ' + command)
+            self.assertTrue('-DARDUINO_AVR_NANO' in command, name + ': ' + command)
+            self.assertTrue('variants/eightanaloginputs' in command, name + ': ' + command)
+            self.assertFalse('variants/standard' in command, name + ': ' + command)
+
+    def test_scoped_board_keeps_links_of_unscoped_board(self):
+        self.project('\n'.join([
+            "env.Replace(VARIANT_DIR = 'build/uno')",
+            "env.ConfigureBoard(164, 'avr', 'uno', options)",
+            "env.CompileExamples(['mylibs/Foo'], ['uno'], options=options)" ]),
+            { 'mylibs/Foo/Foo.h' : '\n',
+              'mylibs/Foo/examples/Hello/Hello.ino' :
+                  '#include <Foo.h>\nvoid setup() {}\nvoid loop() {}\n' })
+        self.scons('arduino-examples')
+        link = join(os.path.dirname(self.hardware), 'uno')
+        self.assertTrue(os.path.islink(link), link + ' was removed')
+
+    def test_arduino_home_tree_used_over_boards_manager(self):
+        hardware = self.boards_manager()
+        home = join(self.scratch, 'home')
+        shutil.copytree(hardware, join(home, 'hardware', 'sam', '1.6.4'))
+        self.env['ARDUINO_HOME'] = home
+        self.env['ARDUINO_TOOLS'] = join(self.scratch, 'sam', 'arduino15', 'packages',
+                                         'arduino', 'tools', 'arm-none-eabi-gcc',
+                                         '4.8.3-2014q1')
+        self.project('\n'.join([
+            "env.ConfigureBoard(164, 'sam', 'arduino_due_x', options)",
+            "print('home ' + env.subst('$ARDUINO_HOME'))" ]))
+        self.assertTrue('home %s\n' % home in self.scons('-n'))
+
+    def test_boards_manager_version_not_installed(self):
+        self.boards_manager()
+        self.project("env.ConfigureBoard(165, 'sam', 'arduino_due_x', options)")
+        out = self.scons('-n', status=2)
+        self.assertTrue('sam 1.6.5 is not installed' in out, out)
+        self.assertTrue('(installed: 1.6.4)' in out, out)
+
+    def test_batched_compiles(self):
+        self.top = join(self.scratch, 'a project')
+        distcc = join(self.scratch, 'bin', 'distcc')
+        write(distcc, '#!/bin/sh\nexec "$@"\n')
+        os.chmod(distcc, 0o755)
+        self.project('\n'.join([
+            "env.Replace(ARDUINO_SCOPED_REPOSITORY = True, ARDUINO_BATCH_COMPILE = 4,",
+            "            DISTCC = %r)" % distcc,
+            "env.ConfigureBoard(164, 'avr', 'uno', options)",
+            "env.ReproducibleBuild()",
+            "env.DistributedCompile(['127.0.0.1:1'])",
+            "env.ArduinoCore()" ]))
+        out = self.scons('-j1')
+        batches = [ line for line in out.splitlines() if line.startswith('cd ') ]
+        self.assertEqual(len(batches), 6, out)
+        for line in batches:
+            self.assertTrue(line.startswith('cd "%s/cores/arduino" && %s ' % (
+                self.top, distcc)), line)
+            self.assertTrue('-frandom-seed=' in line, line)
+        objs = self.built_with('cores/arduino', '.o')
+        self.assertEqual(len(objs), 21, sorted(objs))
+
+    def test_batched_libraries(self):
+        lib = join(self.hardware, 'libraries', 'Wire')
+        write(join(lib, 'Wire.h'), '\n')
+        for name in [ 'Wire.cpp', 'twi.cpp' ]:
+            write(join(lib, name), source_text(name, '#include "Wire.h"\n'))
+        self.project('\n'.join([
+            "env.Replace(ARDUINO_SCOPED_REPOSITORY = True, ARDUINO_BATCH_COMPILE = 8,",
+            "            ARDUINO_BATCH_LIBRARIES = True)",
+            "env.ConfigureBoard(164, 'avr', 'uno', options)",
+            "env.ArduinoLibraries(['SoftwareSerial', 'Wire'])" ]))
+        out = self.scons('-n')
+        batches = [ line for line in out.splitlines() if line.startswith('cd ') ]
+        self.assertEqual(len(batches), 2, out)
+
+if __name__ == '__main__':
+    unittest.main()